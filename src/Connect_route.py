@@ -1,7 +1,12 @@
 import cv2
 import numpy as np
 import rasterio
-from rasterio.transform import from_origin
+from rasterio.windows import Window
+from scipy.ndimage import distance_transform_edt
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
+from metrics import timed, file_size
+from cogTiff import cogWriter
 import os
 
 def read_and_preprocess_tiff(tiff_path):
@@ -20,6 +25,7 @@ def read_and_preprocess_tiff(tiff_path):
     
     return image_8bit
 
+@timed("connect_nearest_contours")
 def connect_nearest_contours(img):
     """ Connect the routes' contours """
 
@@ -29,8 +35,27 @@ def connect_nearest_contours(img):
     # Convert pixels into 0(black) and 1(white)
     _, th = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY)
 
+    # Find the endpoints of the dilated flight lines
+    points = contour_endpoints(th)
+
+    # For drawing the filling lines
+    line_thickness = 15  # 15 for default
+
+    # Connect the closest endpoints
+    for pt1, pt2 in nearest_endpoint_pairs(points):
+        # Draw the shortest line
+        cv2.line(img_color, pt1, pt2, (255, 255, 255), thickness=line_thickness)
+
+    # Convert back to grayscale (single channel) for saving as TIFF
+    img_gray = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
+
+    return img_gray
+
+def contour_endpoints(th, kernel_size=19):
+    """ Dilate a binary image of the flight lines and return the endpoints of each contour """
+
     # Morphological expansion, easier to draw the lines
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (19, 19))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
     morph = cv2.morphologyEx(th, cv2.MORPH_DILATE, kernel)
 
     # Detect the boundries
@@ -44,31 +69,64 @@ def connect_nearest_contours(img):
         top = tuple(c[c[:, :, 1].argmin()][0])
         bottom = tuple(c[c[:, :, 1].argmax()][0])
         points.append({"left": left, "right": right, "top": top, "bottom": bottom})
-
-    # For drawing the filling lines
-    line_thickness = 15  # 15 for default
-
-    # Connect the closest endpoints
-    for i in range(len(points)):
-        min_dist = float("inf")
-        best_pair = None
-
-        for j in range(i + 1, len(points)):
-            for pt1 in points[i].values():
-                for pt2 in points[j].values():
-                    dist = np.linalg.norm(np.array(pt1) - np.array(pt2))
-                    if dist < min_dist:
-                        min_dist = dist
-                        best_pair = (pt1, pt2)
-
-        # Draw the shortest line
-        if best_pair:
-            cv2.line(img_color, best_pair[0], best_pair[1], (255, 255, 255), thickness=line_thickness)
-
-    # Convert back to grayscale (single channel) for saving as TIFF
-    img_gray = cv2.cvtColor(img_color, cv2.COLOR_BGR2GRAY)
-
-    return img_gray
+    return points
+
+def nearest_endpoint_pairs(points):
+    """ For each contour, find the closest pair of endpoints between it and any later contour.
+    Gives the same pairs as comparing every contour with every later one, in n log n time """
+    if len(points) < 2:
+        return []
+
+    # Endpoints as an (n, 4, 2) array, in the order left, right, top, bottom
+    ends = np.array([[pt for pt in p.values()] for p in points], dtype=np.int64)
+    flat = ends.reshape(-1, 2)
+    trees = SuffixTrees(flat)
+
+    pairs = []
+    for i in range(len(points) - 1):
+        # Closest distance from any endpoint of contour i to any endpoint of a later contour
+        blocks = trees.blocks(i + 1, len(points))
+        best = min(np.min(trees.tree(b).query(ends[i])[0]) for b in blocks)
+
+        # All endpoints at that distance, to break ties in the same order as a loop over j, pt1, pt2
+        best_key = None
+        for b in blocks:
+            start = b[0]
+            for a, hits in enumerate(trees.tree(b).query_ball_point(ends[i], best + 1e-6)):
+                for hit in hits:
+                    idx = start * 4 + hit
+                    dist_sq = np.sum((flat[idx] - ends[i, a]) ** 2)
+                    key = (dist_sq, idx // 4, a, idx % 4)
+                    if best_key is None or key < best_key:
+                        best_key = key
+        _, j, a, b_ = best_key
+        pairs.append((tuple(int(v) for v in ends[i, a]), tuple(int(v) for v in ends[j, b_])))
+    return pairs
+
+class SuffixTrees:
+    """ KD-trees over aligned, power of two sized blocks of contours, so that the endpoints
+    of all contours after i can be searched with O(log n) trees """
+    def __init__(self, flat):
+        self.flat = flat
+        self.trees = {}
+
+    def blocks(self, start, stop):
+        """ Split the contours start to stop into aligned blocks of (start, size) """
+        blocks = []
+        while start < stop:
+            size = 1
+            while start % (size * 2) == 0 and start + size * 2 <= stop:
+                size *= 2
+            blocks.append((start, size))
+            start += size
+        return blocks
+
+    def tree(self, block):
+        """ KD-tree of a block's endpoints, built the first time it is needed """
+        if block not in self.trees:
+            start, size = block
+            self.trees[block] = cKDTree(self.flat[start * 4:(start + size) * 4])
+        return self.trees[block]
 
 def save_as_tiff(image, output_path, reference_tiff_path):
     """ Save as a tif file """
@@ -79,24 +137,124 @@ def save_as_tiff(image, output_path, reference_tiff_path):
     # Ensure the output file is in an 8-bit format
     image = image.astype(np.uint8)
 
-    # Write into a new tif file using rasterio
-    with rasterio.open(output_path, 'w', **profile) as dst:
+    # Write into a new tif file, as a COG
+    with cogWriter(output_path, **profile) as dst:
         dst.write(image, 1)  # Write the first band
 
+@timed("fill_gaps_float", lambda tiff_path, output_path, *args, **kwargs: {
+    "bytes_read": file_size(tiff_path), "bytes_written": file_size(output_path)})
+def fill_gaps_float(tiff_path, output_path, tile_size=2048, kernel_size=19, line_thickness=15, overview_size=4096, workers=1):
+    """ Fill the gaps between flight lines on the float elevations, a tile at a time.
+    Holes within the flight lines take the nearest real elevation, and the lines
+    joining the nearest flight line ends are interpolated between the elevations at each end """
 
+    # Raise error
+    if not os.path.exists(tiff_path):
+        raise FileNotFoundError(f"File not found: {tiff_path}")
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    with rasterio.open(tiff_path) as dataset:
+        profile = dataset.profile
+        height, width = dataset.height, dataset.width
+
+    # Find the connecting lines once, for the whole image
+    lines = connection_lines(tiff_path, kernel_size, overview_size)
+
+    # Overlapping tiles, so the nearest real elevation of every filled pixel is within reach
+    halo = kernel_size + line_thickness
+    tiles = [(tiff_path, row, col, min(tile_size, height - row), min(tile_size, width - col), halo, kernel_size, line_thickness, lines)
+             for row in range(0, height, tile_size) for col in range(0, width, tile_size)]
+
+    profile.update(dtype=rasterio.float32, count=1)
+    with cogWriter(output_path, **profile) as dst:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for window, filled in pool.map(fill_tile, *zip(*tiles)):
+                    dst.write(filled, 1, window=window)
+        else:
+            for tile in tiles:
+                window, filled = fill_tile(*tile)
+                dst.write(filled, 1, window=window)
+    print(f"Filled elevations saved to {output_path}")
+
+def connection_lines(tiff_path, kernel_size=19, overview_size=4096):
+    """ Find the lines joining the nearest flight line ends on a reduced copy of the
+    data mask, returning each line's ends in full resolution pixels and their elevations """
+    with rasterio.open(tiff_path) as dataset:
+        # Reduce so that the mask is at most overview_size across, keeping any pixel with data
+        factor = max(1, int(np.ceil(max(dataset.height, dataset.width) / overview_size)))
+        shape = (int(np.ceil(dataset.height / factor)), int(np.ceil(dataset.width / factor)))
+        th = reduced_mask(dataset, factor, shape)
+        small_kernel = max(3, (kernel_size // factor) | 1)
+        points = contour_endpoints(th, small_kernel)
+
+        # Back to full resolution, with the elevation at each end
+        lines = []
+        for pt1, pt2 in nearest_endpoint_pairs(points):
+            ends = [(pt[0] * factor + factor // 2, pt[1] * factor + factor // 2) for pt in (pt1, pt2)]
+            z = [nearest_elevation(dataset, x, y, kernel_size + factor) for x, y in ends]
+            if None not in z:
+                lines.append((ends[0], ends[1], z[0], z[1]))
+    return lines
+
+def reduced_mask(dataset, factor, shape, strip_rows=1024):
+    """ The data mask reduced by factor, a pixel being set if any pixel under it has data.
+    Read in strips of rows to keep the memory down """
+    th = np.zeros(shape, dtype=np.uint8)
+    strip = max(1, strip_rows // factor) * factor
+    for row in range(0, dataset.height, strip):
+        window = Window(0, row, shape[1] * factor, strip)
+        mask = dataset.read_masks(1, window=window, boundless=True) > 0
+        nrows = min(shape[0] - row // factor, strip // factor)
+        block = mask[:nrows * factor].reshape(nrows, factor, shape[1], factor).any(axis=(1, 3))
+        th[row // factor:row // factor + nrows] = block * 255
+    return th
+
+def nearest_elevation(dataset, x, y, radius):
+    """ The real elevation nearest to pixel x, y, within radius pixels """
+    window = Window(x - radius, y - radius, 2 * radius + 1, 2 * radius + 1)
+    data = dataset.read(1, window=window, boundless=True, fill_value=dataset.nodata)
+    rows, cols = np.nonzero(dataset.read_masks(1, window=window, boundless=True))
+    if len(rows) == 0:
+        return None
+    nearest = np.argmin((rows - radius) ** 2 + (cols - radius) ** 2)
+    return float(data[rows[nearest], cols[nearest]])
+
+@timed("fill_tile", lambda tiff_path, row, col, *args: {"row": row, "col": col})
+def fill_tile(tiff_path, row, col, height, width, halo, kernel_size, line_thickness, lines):
+    """ Fill one tile, reading a halo around it. Returns the tile's window and filled elevations """
+    window = Window(col - halo, row - halo, width + 2 * halo, height + 2 * halo)
+    with rasterio.open(tiff_path) as dataset:
+        data = dataset.read(1, window=window, boundless=True, fill_value=dataset.nodata).astype(np.float32)
+        valid = dataset.read_masks(1, window=window, boundless=True) > 0
+
+    # Holes within the flight lines, closed by the kernel, take the nearest real elevation
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+    corridor = cv2.morphologyEx(valid.astype(np.uint8), cv2.MORPH_CLOSE, kernel).astype(bool) & ~valid
+    filled = data.copy()
+    if valid.any() and corridor.any():
+        _, (near_rows, near_cols) = distance_transform_edt(~valid, return_indices=True)
+        filled[corridor] = data[near_rows[corridor], near_cols[corridor]]
+
+    # Lines between flight lines, interpolated between the elevations at their ends
+    for (x1, y1), (x2, y2), z1, z2 in lines:
+        if max(x1, x2) < window.col_off - line_thickness or min(x1, x2) > window.col_off + window.width + line_thickness:
+            continue
+        if max(y1, y2) < window.row_off - line_thickness or min(y1, y2) > window.row_off + window.height + line_thickness:
+            continue
+        # Only the part of the tile around the line, with room for its thickness
+        r0, r1 = max(min(y1, y2) - window.row_off - line_thickness, 0), min(max(y1, y2) - window.row_off + line_thickness + 1, data.shape[0])
+        c0, c1 = max(min(x1, x2) - window.col_off - line_thickness, 0), min(max(x1, x2) - window.col_off + line_thickness + 1, data.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            continue
+        mask = np.zeros((r1 - r0, c1 - c0), dtype=np.uint8)
+        cv2.line(mask, (x1 - window.col_off - c0, y1 - window.row_off - r0), (x2 - window.col_off - c0, y2 - window.row_off - r0), 1, thickness=line_thickness)
+        on_line = (mask > 0) & ~valid[r0:r1, c0:c1]
+        line_rows, line_cols = np.nonzero(on_line)
+        # Position along the line, from 0 at the first end to 1 at the second
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = max(dx * dx + dy * dy, 1)
+        t = ((line_cols + c0 + window.col_off - x1) * dx + (line_rows + r0 + window.row_off - y1) * dy) / length_sq
+        filled[r0:r1, c0:c1][on_line] = z1 + np.clip(t, 0, 1) * (z2 - z1)
+
+    # Drop the halo
+    return Window(col, row, width, height), filled[halo:halo + height, halo:halo + width]
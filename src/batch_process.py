@@ -3,7 +3,22 @@ import click
 import os
 from glob import glob
 from newClass import plotLVIS
+from tileLVIS import lvisTiles, kdSplit
+from lvisClass import findInBounds
+from lvisIndex import lvisIndex
+from lvisCache import cachedLVIS, openLVIS
+from mosaicTiff import demMosaic, mosaicBounds
+from metrics import timed, enable
+from prefetch import read_ahead, BackgroundWriter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
 import numpy as np
+from contextlib import nullcontext
+
+# The grid every DEM is written on: pixel size in metres and EPSG code
+RES = 30
+EPSG = 3031
  
 def get_image_filenames(directory):
     images_in_folders = {}
@@ -14,15 +29,145 @@ def get_image_filenames(directory):
             images_in_folders[subfolder.name] = image_files
     return images_in_folders
 
+@timed("make_dem", lambda lvis, out_name, mosaic=None, writer=None: {"waves": lvis.nWaves, "tile": out_name})
+def make_dem(lvis, out_name, mosaic=None, writer=None):
+    """ Find the ground of one tile and write it as a DEM, or in to the yearly mosaic.
+    With a BackgroundWriter the write is queued, to be done while the next tile is processed """
+    lvis.reprojectLVIS(EPSG) # reproject the data to local UTM zone
+    lvis.estimateGround()    # find ground elevations
+    if writer is not None:
+        writer.submit(lvis.writeDEM, RES, out_name, mosaic=mosaic, epsg=EPSG)
+        return
+    lvis.writeDEM(RES,out_name,mosaic=mosaic,epsg=EPSG)  # write data to a DEM at a sepcific resolution
+
+def tile_units(filename, out_root, use_index=False, max_shots=None):
+    """ List the (file, tile, shots) work units of one hdf5 file, skipping empty tiles.
+    With max_shots, the tiles come from a k-d split holding at most that many shots each.
+    Each unit holds the indices of its shots, so the workers do not read the coordinates again """
+    # create instance of class with "onlyBounds" flag
+    b=plotLVIS(filename,onlyBounds=True,useIndex=use_index)
+
+    if max_shots is not None:
+        return [(filename, out_root, x0, y0, x1, y1, use_ind) for x0, y0, x1, y1, use_ind in kdSplit(b.lon, b.lat, max_shots)]
+
+    # set a step size
+    step=(b.bounds[2]-b.bounds[0])/5
+
+    index = lvisIndex(filename) if use_index else None
+
+    units = []
+    for x0 in np.arange(b.bounds[0],b.bounds[2],step):  # loop over x tiles
+      x1=x0+step   # the right side of the tile
+      for y0 in np.arange(b.bounds[1],b.bounds[3],step):  # loop over y tiles
+        y1=y0+step  # the top of the tile
+        if use_index:
+            use_ind = index.findInBounds(x0,y0,x1,y1)
+        else:
+            use_ind = findInBounds(b.lon,b.lat,x0,y0,x1,y1)
+        if len(use_ind) > 0:
+            units.append((filename, out_root, x0, y0, x1, y1, use_ind))
+    return units
+
+def process_tile(filename, out_root, x0, y0, x1, y1, use_ind, mosaic=None):
+    """ Read, process and write a single tile, reading only its shots and their coordinates. Run by the worker processes """
+    f=openLVIS(filename)
+    try:
+        lvis=plotLVIS.fromSource(f,use_ind)
+    finally:
+        f.close()
+    if mosaic is not None:
+        make_dem(lvis, None, mosaic=mosaic)
+        return mosaic.filename
+    out_name = f"{out_root}lvisDEM.x.{x0}.y.{y0}.tif"  # set output filename
+    make_dem(lvis, out_name)
+    return out_name
+
+def pool_results(units, todo, workers, mosaic=None):
+    """ Run the units at the positions in todo, taking them from its left, with at most workers at once.
+    Yields (position, output name, error) as each finishes. If a worker dies, no more are started, and the
+    units that were running are yielded with a BrokenProcessPool error. The rest are left in todo """
+    broken = False
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        while futures or (todo and not broken):
+            while todo and not broken and len(futures) < workers:
+                try:
+                    future = pool.submit(process_tile, *units[todo[0]], mosaic)
+                except BrokenProcessPool:
+                    broken = True
+                    break
+                futures[future] = todo.popleft()
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures.pop(future)
+                try:
+                    yield i, future.result(), None
+                except Exception as err:
+                    broken = broken or isinstance(err, BrokenProcessPool)
+                    yield i, None, err
+
+def run_parallel(units, workers, retries, mosaic=None):
+    """ Spread the work units over a pool of processes, retrying failed ones. If a worker dies, for example
+    killed for running out of memory, the pool is rebuilt and the units that were running are run again one
+    at a time, so only a unit that kills its worker when run alone uses up its retries """
+    attempts = {}
+    failed = []
+    n_done = 0
+    queue = deque(range(len(units)))
+    suspects = deque()
+    while queue or suspects:
+        alone = len(suspects) > 0
+        for i, out_name, err in pool_results(units, suspects if alone else queue, 1 if alone else workers, mosaic):
+            unit = units[i]
+            if isinstance(err, BrokenProcessPool) and not alone:
+                # running when a worker died, but maybe not the one that killed it
+                suspects.append(i)
+                continue
+            if err is not None:
+                attempts[i] = attempts.get(i, 0) + 1
+                if attempts[i] <= retries:
+                    print(f"Retrying tile {unit[2]},{unit[3]} of {unit[0]} after error: {err!r}")
+                    (suspects if isinstance(err, BrokenProcessPool) else queue).append(i)
+                    continue
+                failed.append(unit)
+                out_name = "nothing, failed"
+            n_done += 1
+            print(f"[{n_done}/{len(units)}] Tile {unit[2]},{unit[3]} of {unit[0]} written to {out_name}")
+        if suspects and not alone:
+            print(f"A worker died, running the {len(suspects)} tiles that were running again one at a time")
+    return failed
+
 @click.command()
 @click.option('--file-path', 'file_path', required=True, help='Path to the files to process.')
-def generate_tiff(file_path):
+@click.option('--workers', default=1, show_default=True, help='Number of processes to spread the tiles over.')
+@click.option('--retries', default=2, show_default=True, help='Times to retry a failed tile when running in parallel.')
+@click.option('--ram-budget', 'ram_budget', default=None, type=float, help='Stream each whole file to one DEM within this many GB of RAM, instead of tiling.')
+@click.option('--mosaic', is_flag=True, help='Write straight in to one yearly mosaic, ./task3/<year>final.tif, covering the files given, instead of a geotiff per tile.')
+@click.option('--index', 'use_index', is_flag=True, help='Keep a sidecar index of bounds, centres and a coarse grid per hdf5 file, built once, so tiles only test the shots near them. Set LVIS_INDEX_DIR if the data directory cannot be written to.')
+@click.option('--cache', 'use_cache', is_flag=True, help='Read from a memory mapped columnar cache of each hdf5 file, made on the first run. Set LVIS_CACHE_DIR if the data directory cannot be written to.')
+@click.option('--prefetch', default=0, show_default=True, help='Read this many tiles, files or streamed blocks ahead in a background thread while one is processed, and write the geotiffs from another thread with at most this many waiting. 0 reads and writes in turn.')
+@click.option('--max-shots', 'max_shots', default=None, type=int, help='Split each file in to tiles of at most this many shots with a k-d tree of the footprints, instead of a 5x5 grid, so no tile is empty and tiles take similar times.')
+@click.option('--metrics', 'metrics_log', default=None, help='Log the time, memory and data of every stage and tile to this JSON lines file.')
+def generate_tiff(file_path, workers, retries, ram_budget, mosaic, use_index, use_cache, prefetch, max_shots, metrics_log):
+    if metrics_log is not None:
+        enable(metrics_log)
   # Loop over the filelists and construct paths
     filelist = glob(file_path)
     if '2015' in filelist[0]:
       out_root_pr ='./tifs/2015/'
+      year = '2015'
     else:
       out_root_pr ='./tifs/2009/'
+      year = '2009'
+    # The yearly mosaic, on the EPSG grid covering all the files, starting with no parts
+    dem_mosaic = None
+    if mosaic:
+        dem_mosaic = demMosaic(f"./task3/{year}final.tif", mosaicBounds(filelist, RES, EPSG, use_index), RES, EPSG)
+        dem_mosaic.clear()
+    units = []
+    serial = []
     for filename in filelist:
         
         # Extract the file name without the extension
@@ -35,39 +180,71 @@ def generate_tiff(file_path):
         # Create the new directory if it doesn't exist
         os.makedirs(out_root, exist_ok=True)
 
-        print('Processing: ' + str(filename))
-        
-        
-        # create instance of class with "onlyBounds" flag
-        b=plotLVIS(filename,onlyBounds=True)
-
-        # set a step size
-        step=(b.bounds[2]-b.bounds[0])/5
-
-        # below, (x0,y0) is the bottom left corner of our tile
-        #   (x1,y1) is the top right corner of our tile
-
-        # loop over spatial subsets
-        for x0 in np.arange(b.bounds[0],b.bounds[2],step):  # loop over x tiles
-          x1=x0+step   # the right side of the tile
-          for y0 in np.arange(b.bounds[1],b.bounds[3],step):  # loop over y tiles
-            y1=y0+step  # the top of the tile
-
-            # print the bounds to screen to check
-            print("Tile between",x0,y0,"to",x1,y1)
-
-            # read in all data within our spatial subset
-            lvis=plotLVIS(filename,minX=x0,minY=y0,maxX=x1,maxY=y1,setElev=True)
-            # check that it contains some data
-            if(lvis.nWaves==0):
-              continue
-
-            # plot waveforms
-            #lvis.plotWaves(step=int(lvis.nWaves/100),outRoot=outRoot+".x."+str(x0)+".y."+str(y0))  # this will print 100 waveforms
-            
-            # updating the filename as it goes
-            # to make a DEM as a geotiff
-            lvis.reprojectLVIS(3031) # reproject the data to local UTM zone
-            lvis.estimateGround()    # find ground elevations
-            outName = f"{out_root}lvisDEM.x.{x0}.y.{y0}.tif"  # set output filename
-            lvis.writeDEM(30,outName)                         # write data to a DEM at a sepcific resolution
\ No newline at end of file
+        # Read from the memory mapped cache of the file, converting it the first time
+        if use_cache:
+            filename = cachedLVIS(filename)
+
+        # Stream the whole file in blocks of shots, within the RAM budget
+        if ram_budget is not None:
+            print('Streaming: ' + str(filename))
+            b=plotLVIS(filename,onlyBounds=True,useIndex=use_index)
+            out_name = f"{out_root}lvisDEM.x.{b.bounds[0]}.y.{b.bounds[1]}.tif"
+            plotLVIS.streamDEM(filename,RES,out_name,epsg=EPSG,ramBudget=ram_budget*1e9,mosaic=dem_mosaic,prefetch=prefetch)
+            continue
+
+        # In parallel, only list the tiles for now
+        if workers > 1:
+            units.extend(tile_units(filename, out_root, use_index, max_shots))
+            continue
+
+        serial.append((filename, out_root))
+
+    # Read each file while the one before is processed, and each tile
+    # while the one before is, writing the geotiffs from a background thread.
+    # Each tile only reads its own rows, so a file read ahead only holds its centres
+    def open_file(item):
+        return lvisTiles(item[0],dataClass=plotLVIS,inMemory=False,useIndex=use_index)
+    if prefetch > 0:
+        files = read_ahead(serial, open_file, prefetch)
+    else:
+        files = ((item, open_file(item)) for item in serial)
+
+    with (BackgroundWriter(prefetch) if prefetch > 0 else nullcontext()) as writer:
+        for (filename, out_root), tiler in files:
+            print('Processing: ' + str(filename))
+
+            # set a step size
+            step=(tiler.bounds[2]-tiler.bounds[0])/5
+
+            # below, (x0,y0) is the bottom left corner of our tile
+            #   (x1,y1) is the top right corner of our tile
+
+            # loop over spatial subsets that contain some data
+            if max_shots is not None:
+                tiles = tiler.kdTiles(max_shots, prefetch=prefetch)
+            else:
+                tiles = tiler.tiles(step, prefetch=prefetch)
+            for x0,y0,x1,y1,lvis in tiles:
+
+                # print the bounds to screen to check
+                print("Tile between",x0,y0,"to",x1,y1)
+
+                # plot waveforms
+                #lvis.plotWaves(step=int(lvis.nWaves/100),outRoot=outRoot+".x."+str(x0)+".y."+str(y0))  # this will print 100 waveforms
+
+                # updating the filename as it goes
+                # to make a DEM as a geotiff
+                outName = f"{out_root}lvisDEM.x.{x0}.y.{y0}.tif"  # set output filename
+                make_dem(lvis, outName, mosaic=dem_mosaic, writer=writer)
+            tiler.close()
+
+    # Process all the tiles of all the files together
+    if units:
+        print(f"Processing {len(units)} tiles with {workers} workers")
+        failed = run_parallel(units, workers, retries, dem_mosaic)
+        if failed:
+            raise click.ClickException(f"{len(failed)} tiles failed: " + ", ".join(f"{u[0]} at {u[2]},{u[3]}" for u in failed))
+
+    # Combine the tiles in to the mosaic, writing each block once
+    if dem_mosaic is not None:
+        dem_mosaic.finish()
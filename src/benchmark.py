@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+from contextlib import contextmanager
+import click
+import numpy as np
+import rasterio
+from synthLVIS import makeLVIS
+from processLVIS import lvisGround
+from newClass import plotLVIS
+from tileLVIS import lvisTiles
+from handleTiff import writeTiff
+from batch_process import make_dem
+from stream_merge import stream_merge
+from merge_year import task3_merge
+from Connect_route import read_and_preprocess_tiff, connect_nearest_contours, fill_gaps_float
+from volume_analysis import volume_analysis
+
+
+YEARS = ('2009', '2015')
+
+@contextmanager
+def working_dir(path):
+    """ Run in path, as task3_merge uses paths relative to src """
+    old = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old)
+
+class Timer:
+    """ Times named stages, keeping every repeat """
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextmanager
+    def stage(self, name, count=None):
+        start = time.perf_counter()
+        yield
+        self.times.setdefault(name, []).append(time.perf_counter() - start)
+        if count is not None:
+            self.counts[name] = count
+
+    def results(self):
+        out = {}
+        for name, times in self.times.items():
+            out[name] = {"best": min(times), "mean": float(np.mean(times)), "runs": times}
+            if name in self.counts:
+                out[name]["shots_per_s"] = self.counts[name] / min(times)
+        return out
+
+def make_files(work, shots, bins, flights, seed):
+    """ Synthetic flights for both years, the later one with the surface 2 m lower """
+    files = {}
+    for k, year in enumerate(YEARS):
+        files[year] = []
+        for flight in range(flights):
+            filename = os.path.join(work, f'ILVIS1B_{year}_{flight}.h5')
+            makeLVIS(filename, nShots=shots, nBins=bins, dZ=-2.0 * k, seed=seed + 10 * k + flight, lat0=-75.5 + 0.025 * flight)
+            files[year].append(filename)
+    return files
+
+def run_once(timer, work, files, shots):
+    """ One pass of every benchmarked stage, from reading the hdf5 to the volume change """
+    first = files[YEARS[0]][0]
+
+    # The single file stages
+    with timer.stage("readLVIS", shots):
+        lvis = lvisGround(first)
+    with timer.stage("setElevations", shots):
+        lvis.setElevations()
+    with timer.stage("estimateGround", shots):
+        lvis.estimateGround()
+    lvis32 = lvisGround(first)
+    with timer.stage("estimateGround_float32", shots):
+        lvis32.estimateGround(precision="float32")
+    check_float32(lvis, lvis32)
+    del lvis32
+    lvis.reprojectLVIS(3031)
+    with timer.stage("writeTiff", shots):
+        writeTiff(lvis.zG, lvis.x, lvis.y, 30, os.path.join(work, 'single.tif'), 3031)
+    del lvis
+
+    # Tiles of every file, then the per-flight and yearly merges
+    for year in YEARS:
+        os.makedirs(os.path.join(work, 'output', year), exist_ok=True)
+        for filename in files[year]:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            tile_dir = os.path.join(work, 'tifs', year, name) + '/'
+            shutil.rmtree(tile_dir, ignore_errors=True)
+            os.makedirs(tile_dir)
+            with timer.stage("tiles_to_dem", shots):
+                tiler = lvisTiles(filename, dataClass=plotLVIS)
+                for x0, y0, x1, y1, tile in tiler.tiles((tiler.bounds[2] - tiler.bounds[0]) / 5):
+                    make_dem(tile, f"{tile_dir}lvisDEM.x.{x0}.y.{y0}.tif")
+                tiler.close()
+            tifs = [os.path.join(tile_dir, tif) for tif in os.listdir(tile_dir)]
+            merged = os.path.join(work, 'output', year, f'merged_output{name}.tif')
+            with timer.stage("flight_merge"):
+                stream_merge(tifs, merged)
+            check_block_size(tifs, merged, work)
+
+    os.makedirs(os.path.join(work, 'task3'), exist_ok=True)
+    with working_dir(work):
+        for year in YEARS:
+            with timer.stage("task3_merge"):
+                task3_merge(year)
+
+    # Gap filling, both on the 8-bit image and on the float elevations
+    connected = {}
+    for year in YEARS:
+        final = os.path.join(work, 'task3', f'{year}final.tif')
+        with timer.stage("connect_nearest_contours"):
+            connect_nearest_contours(read_and_preprocess_tiff(final))
+        connected[year] = os.path.join(work, f'connected{year}.tif')
+        with timer.stage("fill_gaps_float"):
+            fill_gaps_float(final, connected[year])
+
+    # Volume change between the two years
+    resampled = os.path.join(work, 'resampled.tif')
+    with timer.stage("resample_raster"):
+        volume_analysis.resample_raster(connected[YEARS[1]], connected[YEARS[0]], resampled)
+    with timer.stage("volume_analysis"):
+        analyzer = volume_analysis(connected[YEARS[0]], resampled, windowed=True)
+        analyzer.save_elevation_difference_tiff(os.path.join(work, 'elevation_change.tif'))
+        volume = analyzer.report_results()
+
+    # The default in-memory path must give the same answer as the windowed one
+    with timer.stage("volume_analysis_in_memory"):
+        in_memory = volume_analysis(connected[YEARS[0]], resampled)
+        in_memory.save_elevation_difference_tiff(os.path.join(work, 'elevation_change_in_memory.tif'))
+        in_memory_volume = in_memory.report_results()
+    if not np.isclose(in_memory_volume, volume, rtol=1e-4):
+        raise click.ClickException(f"In-memory volume change {in_memory_volume} differs from the windowed {volume}")
+
+def check_block_size(tifs, merged, work, block_size=128):
+    """ A merge in small blocks must give the same output as one in the default blocks """
+    small = os.path.join(work, 'small_blocks.tif')
+    stream_merge(tifs, small, block_size=block_size)
+    with rasterio.open(merged) as a, rasterio.open(small) as b:
+        if not np.array_equal(a.read(), b.read()):
+            raise click.ClickException(f"Merging {merged} in blocks of {block_size} pixels gives a different output")
+    os.remove(small)
+
+def check_float32(lvis, lvis32):
+    """ float32 must find ground in the same shots as the default float64 path, within half a range bin """
+    found = lvis.zG != -999.9
+    if not np.array_equal(found, lvis32.zG != -999.9):
+        raise click.ClickException("float32 found ground in different shots to float64")
+    half_bin = np.abs(lvis.zAxis.lZ0 - lvis.zAxis.lZN)[found] / (lvis.zAxis.nBins - 1) / 2
+    diff = np.abs(lvis32.zG - lvis.zG)[found]
+    if np.any(diff >= half_bin):
+        raise click.ClickException(f"float32 ground is up to {diff.max():.3f} m from float64, over half a range bin")
+    print(f"float32 ground within {diff.max():.3f} m of float64")
+
+def compare(results, baseline, tolerance, min_delta=0.05):
+    """ Stages whose best time is more than tolerance, and min_delta seconds, slower than in the baseline """
+    slower = []
+    for name, result in results.items():
+        if name in baseline and result["best"] > baseline[name]["best"] * (1 + tolerance) + min_delta:
+            slower.append((name, baseline[name]["best"], result["best"]))
+    return slower
+
+@click.command()
+@click.option('--shots', default=50000, show_default=True, help='Waveforms in each synthetic file.')
+@click.option('--bins', default=500, show_default=True, help='Bins in each waveform.')
+@click.option('--flights', default=2, show_default=True, help='Synthetic files per year.')
+@click.option('--repeat', default=3, show_default=True, help='Times to run every stage, the best is compared.')
+@click.option('--seed', default=0, show_default=True, help='Seed for the synthetic data.')
+@click.option('--out', 'out_file', default='./benchmark_results.json', show_default=True, help='Where to write the timings.')
+@click.option('--baseline', default=None, help='Earlier results to compare against, failing if any stage got slower.')
+@click.option('--tolerance', default=0.25, show_default=True, help='Fraction a stage may slow down by before it counts as slower.')
+@click.option('--min-delta', 'min_delta', default=0.05, show_default=True, help='Seconds a stage may slow down by before it counts as slower, so very short stages are not flagged by noise.')
+@click.option('--work-dir', 'work_dir', default=None, help='Where to put the synthetic files, a temporary directory if not set.')
+@click.option('--keep', is_flag=True, help='Keep the synthetic files and outputs.')
+def benchmark(shots, bins, flights, repeat, seed, out_file, baseline, tolerance, min_delta, work_dir, keep):
+    work = os.path.abspath(work_dir) if work_dir else tempfile.mkdtemp(prefix='lvis_bench_')
+    os.makedirs(work, exist_ok=True)
+    timer = Timer()
+    try:
+        with timer.stage("generate"):
+            files = make_files(work, shots, bins, flights, seed)
+        for _ in range(repeat):
+            run_once(timer, work, files, shots)
+    finally:
+        if not keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    results = timer.results()
+    report = {"meta": {"shots": shots, "bins": bins, "flights": flights, "repeat": repeat, "seed": seed,
+                       "python": sys.version.split()[0], "numpy": np.__version__,
+                       "platform": platform.platform(), "cpus": os.cpu_count(),
+                       "date": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": results}
+    with open(out_file, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"\n{'stage':<26}{'best (s)':>10}{'mean (s)':>10}")
+    for name, result in results.items():
+        print(f"{name:<26}{result['best']:>10.3f}{result['mean']:>10.3f}")
+    print(f"Results written to {out_file}")
+
+    if baseline is not None:
+        with open(baseline) as f:
+            old = json.load(f)
+        if (old["meta"]["shots"], old["meta"]["bins"]) != (shots, bins):
+            raise click.ClickException("Baseline was run with a different --shots or --bins")
+        slower = compare(results, old["results"], tolerance, min_delta)
+        if slower:
+            raise click.ClickException("Slower than the baseline: " + ", ".join(f"{name} {a:.3f}s -> {b:.3f}s" for name, a, b in slower))
+        print("No stage slower than the baseline")
+
+if __name__=="__main__":
+    benchmark()
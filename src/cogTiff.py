@@ -0,0 +1,159 @@
+
+'''
+One place for every geotiff writer, so each
+output is a tiled, compressed cloud optimised
+geotiff (COG) with internal overviews
+'''
+
+###################################
+import os
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as copyRaster
+
+
+###################################
+
+# DEFLATE is read by everything, ZSTD is faster
+# at the same size but needs GDAL 2.3 or newer
+compress=os.environ.get('LVIS_TIFF_COMPRESS','DEFLATE').upper()
+blockSize=512
+numThreads='ALL_CPUS'
+
+# layout keys of an input profile, replaced by ours
+layoutKeys=['driver','tiled','blockxsize','blockysize','compress','predictor','interleave',
+            'photometric','zlevel','zstd_level','num_threads','sparse_ok','bigtiff']
+
+
+###################################
+
+def predictorOf(dtype):
+  '''
+  The tiff predictor suited to a data type,
+  floating point (3) or horizontal differencing (2)
+  '''
+  return(3 if np.issubdtype(np.dtype(dtype),np.floating) else 2)
+
+
+###################################
+
+def tiffProfile(profile,compress=compress,level=None,sparse=False):
+  '''
+  A copy of a rasterio profile as a tiled and
+  compressed geotiff with the right predictor,
+  compressed on several threads
+  '''
+  out={key:value for key,value in profile.items() if key not in layoutKeys}
+  out.update({"driver":"GTiff","tiled":True,"blockxsize":blockSize,"blockysize":blockSize,
+              "compress":compress,"predictor":predictorOf(out.get("dtype","float32")),
+              "num_threads":numThreads,"bigtiff":"if_safer"})
+  if(level is not None):
+    out["zstd_level" if compress=="ZSTD" else "zlevel"]=level
+  if(sparse):
+    out["sparse_ok"]=True
+  return(out)
+
+
+###################################
+
+class cogWriter(object):
+  '''
+  Opens a geotiff for writing in the same way as
+  rasterio.open(filename,'w',**profile), and
+  attributes such as write() pass through to it.
+  The data goes to a quickly compressed working
+  file first. On close, overviews are made and the
+  file is copied to a COG at filename in one step,
+  so a half written COG is never left behind
+  '''
+
+  def __init__(self,filename,resampling=None,compress=compress,**profile):
+    '''
+    Class initialiser. resampling is used for the
+    overviews, by default the average for floats
+    and the nearest value for integers
+    '''
+    self.filename=filename
+    self.compress=compress
+    dtype=profile.get("dtype","float32")
+    if(resampling is None):
+      resampling=Resampling.average if np.issubdtype(np.dtype(dtype),np.floating) else Resampling.nearest
+    self.resampling=resampling
+    self.tmpName=filename+'.'+str(os.getpid())+'.tmp'
+    self.dataset=rasterio.open(self.tmpName,'w',**tiffProfile(profile,compress,level=1,sparse=True))
+
+
+  ###########################################
+
+  def __getattr__(self,name):
+    if(name=='dataset'):
+      raise AttributeError(name)
+    return(getattr(self.dataset,name))
+
+  def __enter__(self):
+    return(self)
+
+  def __exit__(self,excType,exc,tb):
+    if(excType is None):
+      self.close()
+    else:
+      self.abort()
+
+
+  ###########################################
+
+  def close(self):
+    '''
+    Finish the working file and
+    copy it to the COG
+    '''
+    if(self.dataset is None):
+      return
+    self.dataset.close()
+    self.dataset=None
+    try:
+      toCOG(self.tmpName,self.filename,resampling=self.resampling,compress=self.compress)
+    finally:
+      os.remove(self.tmpName)
+
+
+  ###########################################
+
+  def abort(self):
+    '''
+    Drop the working file, leaving
+    any earlier output in place
+    '''
+    if(self.dataset is not None):
+      self.dataset.close()
+      self.dataset=None
+    if(os.path.exists(self.tmpName)):
+      os.remove(self.tmpName)
+
+
+###################################
+
+def toCOG(inName,outName,resampling=Resampling.average,compress=compress):
+  '''
+  Copy a raster to a tiled, compressed COG,
+  with internal overviews down to a single tile
+  '''
+  tmpName=outName+'.'+str(os.getpid())+'.cog.tmp'
+  copyRaster(inName,tmpName,driver="COG",COMPRESS=compress,PREDICTOR="YES",BLOCKSIZE=blockSize,
+             NUM_THREADS=numThreads,OVERVIEWS="AUTO",OVERVIEW_RESAMPLING=resampling.name.upper(),BIGTIFF="IF_SAFER")
+  os.replace(tmpName,outName)
+  return(outName)
+
+
+###################################
+
+if __name__=="__main__":
+  '''Main block'''
+  import sys
+  # convert existing geotiffs in place
+  for filename in sys.argv[1:]:
+    with rasterio.open(filename) as src:
+      floating=np.issubdtype(np.dtype(src.dtypes[0]),np.floating)
+    toCOG(filename,filename,resampling=Resampling.average if floating else Resampling.nearest)
+    print(filename,"is now a COG")
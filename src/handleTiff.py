@@ -6,19 +6,23 @@ array of data, x and y
 for a given resolution
 '''
 
-from pyproj import Proj, transform # package for reprojecting data
-from osgeo import gdal             # pacage for handling geotiff data
-from osgeo import osr              # pacage for handling projection information
+from rasterio.windows import Window
+from rasterio.transform import from_origin
+from cogTiff import cogWriter      # tiled, compressed COG output
 import numpy as np
 
 
 
 #####################################
 
-def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326):
+def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326,bands=("mean",),noData=-999.9):
+  '''
+  Make a geotiff from an array of points.
+  All points falling in a pixel are combined,
+  giving one band per statistic in bands, from
+  "mean", "median", "min", "max" and "count".
+  Points set to noData are left out
   '''
-  Make a geotiff from an array of points
-  ''' 
 
   # determine bounds
   minX=np.min(x)
@@ -30,31 +34,208 @@ def writeTiff(data,x,y,res,filename="lvis_image.tif",epsg=4326):
   nX=int((maxX-minX)/res+1)
   nY=int((maxY-minY)/res+1)
 
-  # pack in to array
-  imageArr=np.full((nY,nX),-999.0)        # make an array of missing data flags
-
   # calculate the raster pixel index in x and y
-  xInds=np.array(np.floor((x-np.min(x))/res),dtype=int)   # need to force to int type
-  yInds=np.array(np.floor((np.max(y)-y)/res),dtype=int)
+  use=np.where(data!=noData)[0]
+  xInds=np.array(np.floor((x[use]-minX)/res),dtype=np.int64)   # need to force to int type
+  yInds=np.array(np.floor((maxY-y[use])/res),dtype=np.int64)
   # floor rounds down. y is from top to bottom
 
-  # this is a simple pack which will assign a single footprint to each pixel
-  imageArr[yInds,xInds]=data
+  # combine the footprints in each pixel, only for pixels with data
+  cells,stats=gridPoints(data[use],yInds*nX+xInds,bands)
+
+  # write to disk
+  writeCells(cells,[stats[b] for b in bands],nX,nY,minX,maxY,res,filename=filename,epsg=epsg,names=bands)
+  return
+
+
+#####################################
+
+def gridPoints(data,cells,bands=("mean",)):
+  '''
+  Reduce points to statistics per pixel in one
+  pass. cells is the pixel index of each point.
+  Returns the sorted indices of the pixels with
+  data and a dictionary of float32 arrays per band
+  '''
+  # no points, so no pixels
+  if(len(cells)==0):
+    return(cells,{b:np.empty(0,dtype=np.float32) for b in bands})
+
+  stats={}
+  # sort by pixel, and by value within each pixel
+  if(any(b in ("median","min","max") for b in bands)):
+    order=np.lexsort((data,cells))
+  else:
+    order=np.argsort(cells,kind="stable")
+  cells=cells[order]
+  data=data[order]
+
+  # find where each pixel starts and ends
+  starts=np.concatenate(([0],np.flatnonzero(np.diff(cells))+1))
+  count=np.diff(np.concatenate((starts,[len(cells)])))
+  ends=starts+count
+
+  # work out the statistics
+  for b in bands:
+    if(b=="mean"):
+      stats[b]=np.add.reduceat(data,starts)/count
+    elif(b=="median"):
+      stats[b]=(data[starts+(count-1)//2]+data[starts+count//2])/2.0
+    elif(b=="min"):
+      stats[b]=data[starts]
+    elif(b=="max"):
+      stats[b]=data[ends-1]
+    elif(b=="count"):
+      stats[b]=count
+    else:
+      raise ValueError("Unknown raster statistic "+str(b))
+    stats[b]=stats[b].astype(np.float32)
+  return(cells[starts],stats)
+
 
+#####################################
+
+def writeCells(cells,bandData,nX,nY,minX,maxY,res,filename="lvis_image.tif",epsg=4326,names=None,stripRows=256):
+  '''
+  Write pixel values to a geotiff a strip of rows
+  at a time, so the full image is never in RAM.
+  cells are the sorted pixel indices (row*nX+column)
+  and bandData a list of value arrays, one per band.
+  Strips with no pixels are not written, and read
+  back as no data
+  '''
+  dst_ds=createTiff(nX,nY,minX,maxY,res,filename=filename,epsg=epsg,nBands=len(bandData))
+  for i in range(len(bandData)):
+    if(names is not None):
+      dst_ds.set_band_description(i+1,names[i])
+    for y0 in range(0,nY,stripRows):
+      y1=min(y0+stripRows,nY)
+      # pixels are sorted by row, so each strip is a single run
+      i0,i1=np.searchsorted(cells,[y0*nX,y1*nX])
+      if(i0==i1):
+        continue
+      strip=np.full((y1-y0,nX),-999.0,dtype=np.float32)      # make an array of missing data flags
+      strip.flat[cells[i0:i1]-y0*nX]=bandData[i][i0:i1]
+      dst_ds.write(strip,i+1,window=Window(0,y0,nX,y1-y0))
+  closeTiff(dst_ds,filename)
+
+
+#####################################
+
+def writeArray(imageArr,minX,maxY,res,filename="lvis_image.tif",epsg=4326):
+  '''
+  Write a 2D array to a geotiff, given
+  the coordinate of its top left corner
+  '''
+  nY,nX=imageArr.shape
+  dst_ds=createTiff(nX,nY,minX,maxY,res,filename=filename,epsg=epsg)
+  dst_ds.write(np.asarray(imageArr,dtype=np.float32),1)  # write image to the raster
+  closeTiff(dst_ds,filename)
+  return
+
+
+#####################################
+
+def createTiff(nX,nY,minX,maxY,res,filename="lvis_image.tif",epsg=4326,nBands=1):
+  '''
+  Make an empty geotiff to write in to,
+  which becomes a COG when closed
+  '''
   # set geolocation information (note geotiffs count down from top edge in Y)
-  geotransform = (minX, res, 0, maxY, 0, -res)
+  geotransform=from_origin(minX,maxY,res,res)
 
-  # load data in to geotiff object
-  dst_ds = gdal.GetDriverByName('GTiff').Create(filename, nX, nY, 1, gdal.GDT_Float32)
+  return(cogWriter(filename,driver="GTiff",width=nX,height=nY,count=nBands,dtype="float32",
+                   crs="EPSG:"+str(epsg),transform=geotransform,nodata=-999))
 
-  dst_ds.SetGeoTransform(geotransform)    # specify coords
-  srs = osr.SpatialReference()            # establish encoding
-  srs.ImportFromEPSG(epsg)                # WGS84 lat/long
-  dst_ds.SetProjection(srs.ExportToWkt()) # export coords to file
-  dst_ds.GetRasterBand(1).WriteArray(imageArr)  # write image to the raster
-  dst_ds.GetRasterBand(1).SetNoDataValue(-999)  # set no data value
-  dst_ds.FlushCache()                     # write to disk
-  dst_ds = None
 
+#####################################
+
+def closeTiff(dst_ds,filename):
+  '''
+  Write the geotiff to disk
+  '''
+  dst_ds.close()                          # write to disk
   print("Image written to",filename)
-  return
+
+
+#####################################
+
+class rasterAccumulator(object):
+  '''
+  Averages points in to a raster one
+  batch at a time, so that all the points
+  never need to be in RAM together. The sum
+  and count are held as dense tiles, only
+  for the tiles that points fall in
+  '''
+
+  def __init__(self,bounds,res,tileSize=512):
+    '''
+    Class initialiser. Sets up a raster covering
+    bounds (minX,minY,maxX,maxY) at resolution res,
+    with the same pixel layout as writeTiff()
+    '''
+    self.minX,self.minY,self.maxX,self.maxY=bounds
+    self.res=res
+    self.tileSize=tileSize
+    # determine image size
+    self.nX=int((self.maxX-self.minX)/res+1)
+    self.nY=int((self.maxY-self.minY)/res+1)
+    # running sum and count per pixel, by (tile row,tile column)
+    self.tiles={}
+
+
+  #####################################
+
+  def add(self,data,x,y,noData=-999.9):
+    '''
+    Add a batch of points. Points set
+    to noData (no ground found) are skipped
+    '''
+    use=np.where(data!=noData)[0]
+    # calculate the raster pixel index in x and y
+    xInds=np.array(np.floor((x[use]-self.minX)/self.res),dtype=np.int64)
+    yInds=np.array(np.floor((self.maxY-y[use])/self.res),dtype=np.int64)
+    # group the points by tile, then add each group in to its tile
+    tileInds=(yInds//self.tileSize)*self.nX+xInds//self.tileSize
+    order=np.argsort(tileInds,kind="stable")
+    starts=np.unique(tileInds[order],return_index=True)[1]
+    for i0,i1 in zip(starts,np.append(starts[1:],len(order))):
+      inTile=order[i0:i1]
+      r0=(yInds[inTile[0]]//self.tileSize)*self.tileSize
+      c0=(xInds[inTile[0]]//self.tileSize)*self.tileSize
+      key=(r0,c0)
+      if(key not in self.tiles):
+        shape=(min(self.tileSize,self.nY-r0),min(self.tileSize,self.nX-c0))
+        self.tiles[key]=(np.zeros(shape),np.zeros(shape,dtype=np.int32))
+      total,count=self.tiles[key]
+      np.add.at(total,(yInds[inTile]-r0,xInds[inTile]-c0),data[use[inTile]])
+      np.add.at(count,(yInds[inTile]-r0,xInds[inTile]-c0),1)
+
+
+  #####################################
+
+  def nbytes(self):
+    '''
+    Bytes held by the tiles so far
+    '''
+    return(sum(total.nbytes+count.nbytes for total,count in self.tiles.values()))
+
+
+  #####################################
+
+  def write(self,filename="lvis_image.tif",epsg=4326):
+    '''
+    Write the mean of each pixel to a
+    geotiff, one tile at a time. Tiles
+    no points fell in are left as no data
+    '''
+    dst_ds=createTiff(self.nX,self.nY,self.minX,self.maxY,self.res,filename=filename,epsg=epsg)
+    dst_ds.set_band_description(1,"mean")
+    for (r0,c0),(total,count) in sorted(self.tiles.items()):
+      mean=np.where(count>0,total/np.maximum(count,1),-999.0).astype(np.float32)
+      dst_ds.write(mean,1,window=Window(c0,r0,mean.shape[1],mean.shape[0]))
+    closeTiff(dst_ds,filename)
+
+
+#####################################
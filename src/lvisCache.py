@@ -0,0 +1,174 @@
+
+'''
+A columnar cache of LVIS files: one
+uncompressed .npy file per dataset, which
+can be memory mapped instead of decoded
+'''
+
+###################################
+import os
+import json
+import shutil
+import numpy as np
+import h5py
+
+
+###################################
+
+# bump when the layout of the cache changes
+cacheVersion=1
+
+
+###################################
+
+class lvisCache(object):
+  '''
+  Opens a cache directory made by convertLVIS.
+  Datasets are memory mapped when asked for, so
+  it can stand in for the open h5py file
+  '''
+
+  def __init__(self,path):
+    '''
+    Class initialiser. Reads the list of datasets
+    '''
+    self.path=path
+    with open(os.path.join(path,'meta.json')) as f:
+      self.meta=json.load(f)
+    if(self.meta['version']!=cacheVersion):
+      raise ValueError("Cache "+path+" is version "+str(self.meta['version'])+", not "+str(cacheVersion))
+
+
+  ###########################################
+
+  def __getitem__(self,name):
+    '''
+    A dataset, memory mapped read only
+    '''
+    if(name not in self.meta['datasets']):
+      raise KeyError(name)
+    return(np.load(os.path.join(self.path,name+'.npy'),mmap_mode='r'))
+
+  def __contains__(self,name):
+    return(name in self.meta['datasets'])
+
+  def keys(self):
+    return(list(self.meta['datasets']))
+
+  def close(self):
+    '''
+    Nothing to close, the maps are
+    released with the arrays
+    '''
+    return
+
+
+###########################################
+
+def convertLVIS(filename,cacheDir=None,blockShots=65536):
+  '''
+  Convert an LVIS file to a cache directory, with
+  one .npy file per dataset, copying RXWAVE a
+  block of shots at a time. Returns the cache path
+  '''
+  path=cachePath(filename,cacheDir)
+  tmpPath=path+'.'+str(os.getpid())+'.tmp'
+  shutil.rmtree(tmpPath,ignore_errors=True)
+  os.makedirs(tmpPath)
+  f=h5py.File(filename,'r')
+  try:
+    datasets={}
+    for name in f.keys():
+      dset=f[name]
+      if(not isinstance(dset,h5py.Dataset)):
+        continue
+      out=np.lib.format.open_memmap(os.path.join(tmpPath,name+'.npy'),mode='w+',dtype=dset.dtype,shape=dset.shape)
+      if(dset.ndim==0):
+        out[...]=dset[()]
+      else:
+        for i0 in range(0,dset.shape[0],blockShots):
+          out[i0:i0+blockShots]=dset[i0:i0+blockShots]
+      out.flush()
+      del out
+      datasets[name]={'dtype':dset.dtype.str,'shape':list(dset.shape)}
+  finally:
+    f.close()
+
+  # the source is recorded, to tell when the cache is out of date
+  meta={'version':cacheVersion,'source':os.path.abspath(filename),'stamp':fileStamp(filename),'datasets':datasets}
+  with open(os.path.join(tmpPath,'meta.json'),'w') as f:
+    json.dump(meta,f)
+  shutil.rmtree(path,ignore_errors=True)
+  os.replace(tmpPath,path)
+  return(path)
+
+
+###########################################
+
+def cachePath(filename,cacheDir=None):
+  '''
+  Where the cache of a file is kept, next to it
+  or in cacheDir or the LVIS_CACHE_DIR directory
+  '''
+  if(cacheDir is None):
+    cacheDir=os.environ.get('LVIS_CACHE_DIR')
+  if(cacheDir is None):
+    return(filename+'.cache')
+  return(os.path.join(cacheDir,os.path.basename(filename)+'.cache'))
+
+
+###########################################
+
+def isCache(path):
+  '''
+  Whether a path is a cache directory
+  '''
+  return(os.path.isdir(path) and os.path.exists(os.path.join(path,'meta.json')))
+
+
+###########################################
+
+def cachedLVIS(filename,cacheDir=None):
+  '''
+  The cache of an LVIS file, converting it first
+  if there is no cache or the file has changed
+  '''
+  path=cachePath(filename,cacheDir)
+  if(isCache(path)):
+    with open(os.path.join(path,'meta.json')) as f:
+      meta=json.load(f)
+    if((meta['version']==cacheVersion) and (meta['stamp']==fileStamp(filename))):
+      return(path)
+  return(convertLVIS(filename,cacheDir))
+
+
+###########################################
+
+def fileStamp(filename):
+  '''
+  Size and modification time of a file,
+  to tell when a sidecar or cache is out of date
+  '''
+  stat=os.stat(filename)
+  return([stat.st_size,stat.st_mtime_ns])
+
+
+###########################################
+
+def openLVIS(filename):
+  '''
+  Open an LVIS file or cache directory for reading
+  '''
+  if(isCache(filename)):
+    return(lvisCache(filename))
+  return(h5py.File(filename,'r'))
+
+
+###########################################
+
+if __name__=="__main__":
+  '''Main block'''
+  import sys
+  # convert the files given
+  for filename in sys.argv[1:]:
+    print(filename,"cached to",cachedLVIS(filename))
@@ -0,0 +1,309 @@
+
+'''
+A catalogue of a directory of LVIS files,
+to find which shots of which flights
+cover an area without opening every file
+'''
+
+###################################
+import os
+import re
+from glob import glob
+import numpy as np
+from lvisClass import lvisData
+from lvisIndex import lvisIndex,indexPath
+from lvisCache import openLVIS,fileStamp
+
+
+###################################
+
+# bump when the layout of the saved catalogue changes
+catalogueVersion=1
+
+
+###################################
+
+class lvisCatalogue(object):
+  '''
+  Extents of every file in an archive, and of
+  each chunk of consecutive shots within them,
+  with the acquisition date of each file.
+  Queries test the file extents first and then
+  only the chunks of the files that match
+  '''
+
+  def __init__(self,directory,pattern="**/ILVIS1B_*.h5",chunkShots=4096,indexDir=None,rebuild=False):
+    '''
+    Class initialiser. Loads the saved catalogue if
+    no file has changed, otherwise builds it from
+    each file's lvisIndex sidecar
+    '''
+    self.directory=directory
+    self.chunkShots=chunkShots
+    self.indexDir=indexDir
+    self.files=sorted(glob(os.path.join(directory,pattern),recursive=True))
+    self.catalogueName=indexPath(os.path.join(directory,"lvisCatalogue"),indexDir)
+    if((not rebuild) and self.load()):
+      return
+    self.build()
+    self.save()
+
+
+  ###########################################
+
+  def load(self):
+    '''
+    Load the saved catalogue, returning False if there
+    is none or any file has been added, removed or changed
+    '''
+    if(not os.path.exists(self.catalogueName)):
+      return(False)
+    with np.load(self.catalogueName) as npz:
+      if((int(npz['version'])!=catalogueVersion) or (int(npz['chunkShots'])!=self.chunkShots)):
+        return(False)
+      if(list(npz['files'])!=self.files):
+        return(False)
+      if(not np.array_equal(npz['stamps'],self.stamps())):
+        return(False)
+      for name in ['years','dates','fileBounds','chunkFile','chunkStart','chunkEnd','chunkBounds']:
+        setattr(self,name,npz[name])
+    return(True)
+
+
+  ###########################################
+
+  def build(self):
+    '''
+    Work out the extent of each file and
+    of each chunk of chunkShots shots
+    '''
+    nFiles=len(self.files)
+    self.years=np.zeros(nFiles,dtype=int)
+    self.dates=np.empty(nFiles,dtype='<U10')
+    self.fileBounds=np.full((nFiles,4),np.nan)
+    chunkFile,chunkStart,chunkEnd,chunkBounds=[],[],[],[]
+    for i,filename in enumerate(self.files):
+      self.dates[i]=flightDate(filename)
+      self.years[i]=int(self.dates[i][:4]) if self.dates[i] else 0
+      index=lvisIndex(filename,indexDir=self.indexDir)
+      if(index.nShots==0):
+        continue
+      self.fileBounds[i]=index.bounds
+      starts=np.arange(0,index.nShots,self.chunkShots)
+      chunkFile.append(np.full(len(starts),i))
+      chunkStart.append(starts)
+      chunkEnd.append(np.minimum(starts+self.chunkShots,index.nShots))
+      chunkBounds.append(np.stack([np.minimum.reduceat(index.lon,starts),np.minimum.reduceat(index.lat,starts),
+                                   np.maximum.reduceat(index.lon,starts),np.maximum.reduceat(index.lat,starts)],axis=1))
+    self.chunkFile=np.concatenate(chunkFile) if chunkFile else np.empty(0,dtype=int)
+    self.chunkStart=np.concatenate(chunkStart) if chunkStart else np.empty(0,dtype=int)
+    self.chunkEnd=np.concatenate(chunkEnd) if chunkEnd else np.empty(0,dtype=int)
+    self.chunkBounds=np.concatenate(chunkBounds) if chunkBounds else np.empty((0,4))
+
+
+  ###########################################
+
+  def save(self):
+    '''
+    Write the catalogue in one step. Carries on
+    without saving if it cannot be written
+    '''
+    tmpName=self.catalogueName+'.'+str(os.getpid())+'.tmp.npz'
+    try:
+      np.savez(tmpName,version=catalogueVersion,chunkShots=self.chunkShots,files=np.array(self.files,dtype=str),
+               stamps=self.stamps(),years=self.years,dates=self.dates,fileBounds=self.fileBounds,chunkFile=self.chunkFile,
+               chunkStart=self.chunkStart,chunkEnd=self.chunkEnd,chunkBounds=self.chunkBounds)
+      os.replace(tmpName,self.catalogueName)
+    except OSError as err:
+      print("Could not write catalogue "+self.catalogueName+": "+str(err))
+
+
+  ###########################################
+
+  def stamps(self):
+    '''
+    Size and modification time of every file
+    '''
+    return(np.array([fileStamp(filename) for filename in self.files],dtype=np.int64).reshape(-1,2))
+
+
+  ###########################################
+
+  def query(self,bbox,years=None):
+    '''
+    Shot ranges that may hold footprints in
+    bbox (minX,minY,maxX,maxY), from the files of
+    the given years (all if None). Returns a list of
+    (filename,start,end) with end one past the last
+    shot. Neighbouring chunks are joined in to one range
+    '''
+    minX,minY,maxX,maxY=bbox
+    useFile=overlaps(self.fileBounds,minX,minY,maxX,maxY)
+    if(years is not None):
+      useFile&=np.isin(self.years,[int(y) for y in np.atleast_1d(years)])
+    useChunk=np.where(useFile[self.chunkFile]&overlaps(self.chunkBounds,minX,minY,maxX,maxY))[0]
+
+    ranges=[]
+    for i in np.unique(self.chunkFile[useChunk]):
+      chunks=useChunk[self.chunkFile[useChunk]==i]
+      # join runs of neighbouring chunks
+      breaks=np.where(np.diff(chunks)!=1)[0]
+      firsts=chunks[np.concatenate(([0],breaks+1))]
+      lasts=chunks[np.concatenate((breaks,[len(chunks)-1]))]
+      for first,last in zip(firsts,lasts):
+        ranges.append((self.files[i],int(self.chunkStart[first]),int(self.chunkEnd[last])))
+    return(ranges)
+
+
+  ###########################################
+
+  def collection(self,bbox,years=None,dataClass=lvisData):
+    '''
+    A lazily loaded collection of the shots in
+    bbox, one dataClass object per file
+    '''
+    return(lvisCollection(self.query(bbox,years),bbox,dataClass,self.indexDir))
+
+
+###########################################
+
+class lvisCollection(object):
+  '''
+  The shots within a box across several files.
+  Nothing is read until a file's shots are asked
+  for, and then only the rows that hold them
+  '''
+
+  def __init__(self,ranges,bbox,dataClass=lvisData,indexDir=None):
+    '''
+    Class initialiser. ranges is the list of
+    (filename,start,end) from lvisCatalogue.query()
+    '''
+    self.bbox=bbox
+    self.dataClass=dataClass
+    self.indexDir=indexDir
+    self.files=[]
+    self.ranges={}
+    for filename,start,end in ranges:
+      if(filename not in self.ranges):
+        self.files.append(filename)
+        self.ranges[filename]=[]
+      self.ranges[filename].append((start,end))
+
+
+  ###########################################
+
+  def __len__(self):
+    return(len(self.files))
+
+  def __iter__(self):
+    '''
+    Loop over the files, reading each in turn
+    '''
+    for i in range(len(self.files)):
+      yield(self[i])
+
+
+  ###########################################
+
+  def shotIndices(self,i):
+    '''
+    Indices of the shots of file i within the box,
+    tested against the centres in its sidecar.
+    Returns the indices and the sidecar
+    '''
+    index=lvisIndex(self.files[i],indexDir=self.indexDir)
+    minX,minY,maxX,maxY=self.bbox
+    cand=np.concatenate([np.arange(start,end) for start,end in self.ranges[self.files[i]]])
+    lon,lat=index.lon[cand],index.lat[cand]
+    return(cand[(lon>=minX)&(lon<maxX)&(lat>=minY)&(lat<maxY)],index)
+
+
+  ###########################################
+
+  def __getitem__(self,i):
+    '''
+    The shots of file i within the box,
+    as a dataClass object
+    '''
+    useInd,index=self.shotIndices(i)
+    f=openLVIS(self.files[i])
+    try:
+      return(self.dataClass.fromSource(f,useInd,index.lon,index.lat))
+    finally:
+      f.close()
+
+
+  ###########################################
+
+  def nWaves(self):
+    '''
+    Number of shots within the box in all
+    files, only reading the sidecars
+    '''
+    return(sum(len(self.shotIndices(i)[0]) for i in range(len(self.files))))
+
+
+  ###########################################
+
+  def read(self):
+    '''
+    All the shots within the box as one dataClass
+    object. The files must have the same number of bins
+    '''
+    parts=[part for part in self if part.nWaves>0]
+    if(len(parts)==0):
+      empty=self.dataClass.__new__(self.dataClass)
+      empty.nWaves=0
+      return(empty)
+    if(len(set(part.nBins for part in parts))>1):
+      raise ValueError("Files in the collection have different numbers of bins")
+    nBins=parts[0].nBins
+    data={'LFID':np.concatenate([part.lfid for part in parts]),
+          'SHOTNUMBER':np.concatenate([part.lShot for part in parts]),
+          'RXWAVE':np.concatenate([part.waves for part in parts]),
+          'Z0':np.concatenate([part.lZ0 for part in parts]),
+          'Z'+str(nBins-1):np.concatenate([part.lZN for part in parts])}
+    lon=np.concatenate([part.lon for part in parts])
+    lat=np.concatenate([part.lat for part in parts])
+    del parts
+    return(self.dataClass.fromSource(data,np.arange(len(lon)),lon,lat))
+
+
+###########################################
+
+def overlaps(bounds,minX,minY,maxX,maxY):
+  '''
+  Which minX,minY,maxX,maxY extents could
+  hold footprints within a box, using the
+  same edges as findInBounds
+  '''
+  return((bounds[:,0]<maxX)&(bounds[:,2]>=minX)&(bounds[:,1]<maxY)&(bounds[:,3]>=minY))
+
+
+###########################################
+
+def flightDate(filename):
+  '''
+  Acquisition date of a file as YYYY-MM-DD, from
+  LVIS names such as ILVIS1B_AQ2015_1014_R1605_070717.h5,
+  or just the year from anywhere in the path
+  '''
+  match=re.search(r'_[A-Z]{2}(\d{4})_(\d{2})(\d{2})_',os.path.basename(filename))
+  if(match):
+    return(match.group(1)+'-'+match.group(2)+'-'+match.group(3))
+  match=re.search(r'(?<!\d)((?:19|20)\d{2})(?!\d)',filename)
+  return(match.group(1) if match else '')
+
+
+###########################################
+
+if __name__=="__main__":
+  '''Main block'''
+  import sys
+  # directory minX minY maxX maxY [years...]
+  cat=lvisCatalogue(sys.argv[1])
+  bbox=[float(v) for v in sys.argv[2:6]]
+  years=[int(y) for y in sys.argv[6:]] or None
+  for filename,start,end in cat.query(bbox,years):
+    print(filename,start,end)
@@ -6,7 +6,8 @@ with methods to read
 
 ###################################
 import numpy as np
-import h5py
+from metrics import timed
+from lvisCache import openLVIS
 
 
 ###################################
@@ -16,7 +17,7 @@ class lvisData(object):
   LVIS data handler
   '''
 
-  def __init__(self,filename,setElev=False,minX=-100000000,maxX=100000000,minY=-1000000000,maxY=100000000,onlyBounds=False):
+  def __init__(self,filename,setElev=False,minX=-100000000,maxX=100000000,minY=-1000000000,maxY=100000000,onlyBounds=False,useIndex=False):
     '''
     Class initialiser. Calls a function
     to read LVIS data within bounds
@@ -24,80 +25,137 @@ class lvisData(object):
     setElev=1 converts LVIS's stop and start
     elevations to arrays of elevation.
     onlyBounds sets "bounds" to the corner of the area of interest
+    useIndex takes the bounds, centres and subset from
+    the file's lvisIndex sidecar, building it if needed
     '''
     # call the file reader and load in to the self
-    self.readLVIS(filename,minX,minY,maxX,maxY,onlyBounds)
+    self.readLVIS(filename,minX,minY,maxX,maxY,onlyBounds,useIndex)
     if(setElev):     # to save time, only read elev if wanted
       self.setElevations()
 
 
   ###########################################
 
-  def readLVIS(self,filename,minX,minY,maxX,maxY,onlyBounds):
+  @timed("readLVIS",lambda self,*args,**kwargs:{"waves":self.nWaves,"bytes_read":self.bytesRead})
+  def readLVIS(self,filename,minX,minY,maxX,maxY,onlyBounds,useIndex=False):
     '''
     Read LVIS data from file
     '''
+    # bounds and centres from the sidecar, without touching the file
+    if(useIndex):
+      from lvisIndex import lvisIndex
+      index=lvisIndex(filename)
+      self.nBins=index.nBins
+      self.bytesRead=0
+      if(onlyBounds):
+        self.lon=index.lon
+        self.lat=index.lat
+        self.bounds=index.bounds
+        self.nWaves=0
+        return
+
     # open file for reading
-    f=h5py.File(filename,'r')
+    f=openLVIS(filename)
     # determine how many bins
     self.nBins=f['RXWAVE'].shape[1]
-    # read coordinates for subsetting
-    lon0=np.array(f['LON0'])       # longitude of waveform top
-    lat0=np.array(f['LAT0'])       # lattitude of waveform top
-    lonN=np.array(f['LON'+str(self.nBins-1)]) # longitude of waveform bottom
-    latN=np.array(f['LAT'+str(self.nBins-1)]) # lattitude of waveform bottom
-    # find a single coordinate per footprint
-    tempLon=(lon0+lonN)/2.0
-    tempLat=(lat0+latN)/2.0
-
-    # write out bounds and leave if needed
-    if(onlyBounds):
-      self.lon=tempLon
-      self.lat=tempLat
-      self.bounds=self.dumpBounds()
-      self.nWaves=0
-      return
+    if(useIndex):
+      # only test the shots in the grid cells overlapping the box
+      tempLon,tempLat=index.lon,index.lat
+      useInd=index.findInBounds(minX,minY,maxX,maxY)
+    else:
+      # find a single coordinate per footprint
+      tempLon,tempLat=readCentres(f,self.nBins)
+      self.bytesRead=4*tempLon.nbytes     # four coordinate datasets
 
-    # dertermine which are in region of interest
-    useInd=np.where((tempLon>=minX)&(tempLon<maxX)&(tempLat>=minY)&(tempLat<maxY))
-    if(len(useInd)>0):
-      useInd=useInd[0]
+      # write out bounds and leave if needed
+      if(onlyBounds):
+        self.lon=tempLon
+        self.lat=tempLat
+        self.bounds=self.dumpBounds()
+        self.nWaves=0
+        f.close()
+        return
+
+      # dertermine which are in region of interest
+      useInd=findInBounds(tempLon,tempLat,minX,minY,maxX,maxY)
 
     if(len(useInd)==0):
       print("No data contained in that region")
       self.nWaves=0
+      f.close()
       return
 
+    # load the subset of all data
+    self.setShots(f,useInd,tempLon,tempLat)
+    # close file
+    f.close()
+    # return to initialiser
+    return
+
+
+  ###########################################
+
+  def setShots(self,f,useInd,tempLon=None,tempLat=None):
+    '''
+    Load the shots useInd from an open file,
+    or anything else holding the LVIS datasets.
+    Without the centres of the whole file, the
+    coordinates of only these shots are read
+    '''
     # save the subset of all data
     self.nWaves=len(useInd)
-    self.lon=tempLon[useInd]
-    self.lat=tempLat[useInd]
+    if(tempLon is None):
+      self.lon,self.lat=readCentres(f,f['RXWAVE'].shape[1],useInd)
+    else:
+      self.lon=tempLon[useInd]
+      self.lat=tempLat[useInd]
 
-    # load sliced arrays, to save RAM
-    self.lfid=np.array(f['LFID'])[useInd]          # LVIS flight ID number
-    self.lShot=np.array(f['SHOTNUMBER'])[useInd]   # the LVIS shot number, a label
-    self.waves=np.array(f['RXWAVE'])[useInd]       # the recieved waveforms. The data
+    # load only the blocks holding the subset, to save RAM and time
+    self.lfid,nLfid=readShots(f['LFID'],useInd)          # LVIS flight ID number
+    self.lShot,nShot=readShots(f['SHOTNUMBER'],useInd)   # the LVIS shot number, a label
+    self.waves,nWave=readShots(f['RXWAVE'],useInd)       # the recieved waveforms. The data
     self.nBins=self.waves.shape[1]
     # these variables will be converted to easier variables
-    self.lZN=np.array(f['Z'+str(self.nBins-1)])[useInd]       # The elevation of the waveform bottom
-    self.lZ0=np.array(f['Z0'])[useInd]          # The elevation of the waveform top
-    # close file
-    f.close()
-    # return to initialiser
-    return
+    self.lZN,nZN=readShots(f['Z'+str(self.nBins-1)],useInd)       # The elevation of the waveform bottom
+    self.lZ0,nZ0=readShots(f['Z0'],useInd)          # The elevation of the waveform top
+    # keep track of how much was read
+    self.bytesRead=getattr(self,'bytesRead',0)+nLfid+nShot+nWave+nZN+nZ0
+    # bin elevations, worked out when needed
+    self.zAxis=elevationAxis(self.lZ0,self.lZN,self.nBins)
+
+
+  ###########################################
+
+  @classmethod
+  @timed("fromSource",lambda cls,f,useInd,*args:{"waves":len(useInd)})
+  def fromSource(cls,f,useInd,tempLon=None,tempLat=None):
+    '''
+    Make a new object from the shots useInd of an
+    already open file, without reading the coordinates
+    again. tempLon and tempLat are the footprint
+    centres of the whole file. If they are not given,
+    the coordinates of only the shots useInd are read
+    '''
+    lvis=cls.__new__(cls)
+    lvis.nBins=f['RXWAVE'].shape[1]
+    if(len(useInd)==0):
+      lvis.nWaves=0
+    else:
+      lvis.setShots(f,useInd,tempLon,tempLat)
+    return(lvis)
+
 
- 
   ###########################################
 
-  def setElevations(self):
+  @timed("setElevations",lambda self,*args,**kwargs:{"waves":self.nWaves})
+  def setElevations(self,dtype=np.float64):
     '''
     Decodes LVIS's RAM efficient elevation
     format and produces an array of
-    elevations per waveform bin
+    elevations per waveform bin.
+    dtype=np.float32 halves the size of z
     '''
-    self.z=np.empty((self.nWaves,self.nBins))
-    for i in range(0,self.nWaves):    # loop over waves
-      self.z[i]=np.linspace(self.lZ0[i],self.lZN[i],self.nBins)   # returns an array of floats
+    self.z=self.zAxis[:].astype(dtype,copy=False)
 
 
   ###########################################
@@ -106,7 +164,7 @@ class lvisData(object):
     '''
     Return a single waveform
     '''
-    return(self.z[ind],self.waves[ind])
+    return(self.zAxis[ind],self.waves[ind])
 
 
   ###########################################
@@ -128,3 +186,170 @@ class lvisData(object):
 
 ###########################################
 
+
+###########################################
+
+def readCentres(f,nBins,useInd=None):
+  '''
+  Read the coordinates of the top and bottom
+  of each waveform and return the footprint centres,
+  of every shot or only of the sorted shots useInd
+  '''
+  # read coordinates for subsetting
+  if(useInd is None):
+    read=lambda name:np.array(f[name])
+  else:
+    read=lambda name:readShots(f[name],useInd)[0]
+  lon0=read('LON0')       # longitude of waveform top
+  lat0=read('LAT0')       # lattitude of waveform top
+  lonN=read('LON'+str(nBins-1)) # longitude of waveform bottom
+  latN=read('LAT'+str(nBins-1)) # lattitude of waveform bottom
+  # find a single coordinate per footprint
+  tempLon=(lon0+lonN)/2.0
+  tempLat=(lat0+latN)/2.0
+  return(tempLon,tempLat)
+
+
+###########################################
+
+def findInBounds(tempLon,tempLat,minX,minY,maxX,maxY):
+  '''
+  Indices of the footprints within a box
+  '''
+  return(np.where((tempLon>=minX)&(tempLon<maxX)&(tempLat>=minY)&(tempLat<maxY))[0])
+
+
+###########################################
+
+def readShots(dset,useInd,maxGap=None):
+  '''
+  Read the shots useInd from a dataset, only
+  reading the blocks of rows that hold them.
+  useInd must be sorted. Runs of shots less than
+  maxGap apart are read as one block, which
+  defaults to the chunk size of HDF5 datasets.
+  Returns the shots and the number of bytes read
+  '''
+  # contiguous shots of an in-memory or memory mapped array need no copy
+  if(isinstance(dset,np.ndarray) and (len(useInd)>0) and (useInd[-1]-useInd[0]+1==len(useInd))):
+    data=dset[useInd[0]:useInd[-1]+1]
+    return(data,data.nbytes)
+
+  # set the largest gap to read through
+  if(maxGap is None):
+    chunks=getattr(dset,'chunks',None)
+    maxGap=chunks[0] if chunks else 256
+
+  # array for the output
+  data=np.empty((len(useInd),)+dset.shape[1:],dtype=dset.dtype)
+  rowBytes=data.itemsize*int(np.prod(dset.shape[1:]))
+
+  # read block by block
+  nRead=0
+  starts,ends=shotBlocks(useInd,maxGap)
+  for start,end in zip(starts,ends):
+    first=np.searchsorted(useInd,start)
+    last=np.searchsorted(useInd,end)
+    if((last-first==end-start) and hasattr(dset,'read_direct')):
+      # every row of the block is wanted, so read it straight in to place
+      dset.read_direct(data,np.s_[start:end],np.s_[first:last])
+    else:
+      data[first:last]=dset[start:end][useInd[first:last]-start]
+    nRead+=(end-start)*rowBytes
+  return(data,nRead)
+
+
+###########################################
+
+def shotBlocks(useInd,maxGap):
+  '''
+  Group sorted shot indices in to blocks
+  of rows to read, returning the first
+  and one past the last row of each
+  '''
+  if(len(useInd)==0):
+    return(np.empty(0,dtype=int),np.empty(0,dtype=int))
+  breaks=np.where(np.diff(useInd)>maxGap)[0]
+  starts=useInd[np.concatenate(([0],breaks+1))]
+  ends=useInd[np.concatenate((breaks,[len(useInd)-1]))]+1
+  return(starts,ends)
+
+
+###########################################
+
+class elevationAxis(object):
+  '''
+  Elevations of every waveform bin, worked out
+  on demand from the top and bottom elevations
+  rather than held as a nWaves x nBins array
+  '''
+
+  def __init__(self,lZ0,lZN,nBins):
+    '''
+    Class initialiser. Only keeps the
+    compressed elevations
+    '''
+    self.lZ0=lZ0
+    self.lZN=lZN
+    self.nBins=nBins
+    self.shape=(len(lZ0),nBins)
+
+
+  ###########################################
+
+  def __len__(self):
+    return(self.shape[0])
+
+
+  ###########################################
+
+  def __getitem__(self,ind):
+    '''
+    Elevations of the waveforms picked out by ind,
+    which can be an integer, slice or index array.
+    A second index picks out bins, as for self.z
+    '''
+    if(isinstance(ind,tuple)):
+      ind,binInd=ind[0],ind[1:]
+    else:
+      binInd=()
+    z=self.block(self.lZ0[ind],self.lZN[ind])
+    return(z[(Ellipsis,)+binInd])
+
+
+  ###########################################
+
+  def block(self,lZ0,lZN):
+    '''
+    Bin elevations for arrays of top and bottom
+    elevations. Matches np.linspace for each wave
+    '''
+    lZ0=np.asarray(lZ0,dtype=np.float64)
+    lZN=np.asarray(lZN,dtype=np.float64)
+    step=(lZN-lZ0)/(self.nBins-1)
+    z=np.arange(self.nBins)*step[...,np.newaxis]+lZ0[...,np.newaxis]
+    z[...,-1]=lZN     # last bin exactly at the bottom
+    return(z)
+
+
+  ###########################################
+
+  def at(self,ind,binPos):
+    '''
+    Elevations at fractional bin positions
+    binPos of the waveforms picked out by ind
+    '''
+    lZ0=self.lZ0[ind]
+    return(lZ0+binPos*(self.lZN[ind]-lZ0)/(self.nBins-1))
+
+
+  ###########################################
+
+  def res(self):
+    '''
+    Range resolution, taken from the first waveform
+    '''
+    return((self.lZ0[0]-self.lZN[0])/self.nBins)
+
+
+###########################################
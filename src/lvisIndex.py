@@ -0,0 +1,222 @@
+
+'''
+A sidecar index for each LVIS file, holding
+its bounds, footprint centres and a coarse
+grid of which shots fall in each cell
+'''
+
+###################################
+import os
+import hashlib
+import numpy as np
+from lvisCache import openLVIS,fileStamp
+
+
+###################################
+
+# bump when the layout of the sidecar changes
+indexVersion=1
+
+
+###################################
+
+class lvisIndex(object):
+  '''
+  Bounds, footprint centres and a coarse spatial
+  grid of an LVIS file, built once and kept in a
+  sidecar file next to it (or in indexDir, or the
+  LVIS_INDEX_DIR environment variable, for archives
+  that cannot be written to)
+  '''
+
+  def __init__(self,filename,indexDir=None,rebuild=False,gridSize=128):
+    '''
+    Class initialiser. Loads the sidecar if it
+    matches the file's size and modification
+    time, otherwise builds and saves it
+    '''
+    self.filename=filename
+    self.indexName=indexPath(filename,indexDir)
+    self._lon=self._lat=None
+    if((not rebuild) and self.load()):
+      return
+    self.build(gridSize)
+    self.save()
+
+
+  ###########################################
+
+  def load(self):
+    '''
+    Load the small arrays of the sidecar, leaving the
+    centres on disk until needed. Returns False if
+    there is no sidecar or it is out of date
+    '''
+    if(not os.path.exists(self.indexName)):
+      return(False)
+    self.npz=np.load(self.indexName)
+    if((int(self.npz['version'])!=indexVersion) or (list(self.npz['stamp'])!=fileStamp(self.filename))):
+      self.npz.close()
+      return(False)
+    self.nShots=int(self.npz['nShots'])
+    self.nBins=int(self.npz['nBins'])
+    self.bounds=list(self.npz['bounds'])
+    self.grid=self.npz['grid']
+    self.cellStart=self.npz['cellStart']
+    self.runStart=self.npz['runStart']
+    self.runEnd=self.npz['runEnd']
+    self.coordHash=str(self.npz['coordHash'])
+    return(True)
+
+
+  ###########################################
+
+  def build(self,gridSize=128):
+    '''
+    Read the coordinates once and grid
+    the shots in to gridSize x gridSize cells
+    '''
+    from lvisClass import readCentres
+    self.npz=None
+    f=openLVIS(self.filename)
+    self.nShots,self.nBins=f['RXWAVE'].shape
+    self._lon,self._lat=readCentres(f,self.nBins)
+    f.close()
+    self.coordHash=hashlib.sha256(self._lon.tobytes()+self._lat.tobytes()).hexdigest()
+    if(self.nShots==0):
+      self.bounds=[np.nan]*4
+    else:
+      self.bounds=[np.min(self._lon),np.min(self._lat),np.max(self._lon),np.max(self._lat)]
+
+    # the grid as x0,y0,dx,dy,nx,ny
+    nX=nY=gridSize
+    dX=max((self.bounds[2]-self.bounds[0])/nX,1e-9)
+    dY=max((self.bounds[3]-self.bounds[1])/nY,1e-9)
+    self.grid=np.array([self.bounds[0],self.bounds[1],dX,dY,nX,nY])
+
+    # runs of consecutive shots in each cell, held as
+    # cellStart offsets in to runStart and runEnd
+    cell=self.cellOf(self._lon,self._lat)
+    order=np.argsort(cell,kind='stable')
+    sortedCell=cell[order]
+    newRun=np.ones(self.nShots,dtype=bool)
+    newRun[1:]=(np.diff(sortedCell)!=0)|(np.diff(order)!=1)
+    firsts=np.where(newRun)[0]
+    self.runStart=order[firsts]
+    self.runEnd=order[np.append(firsts[1:],self.nShots)-1]+1
+    self.cellStart=np.searchsorted(sortedCell[firsts],np.arange(nX*nY+1))
+
+
+  ###########################################
+
+  def save(self):
+    '''
+    Write the sidecar in one step, so it is never
+    half written. Carries on without one if the
+    directory cannot be written to
+    '''
+    tmpName=self.indexName+'.'+str(os.getpid())+'.tmp.npz'
+    try:
+      np.savez(tmpName,version=indexVersion,stamp=fileStamp(self.filename),nShots=self.nShots,nBins=self.nBins,
+               bounds=self.bounds,grid=self.grid,lon=self._lon,lat=self._lat,cellStart=self.cellStart,
+               runStart=self.runStart,runEnd=self.runEnd,coordHash=self.coordHash)
+      os.replace(tmpName,self.indexName)
+    except OSError as err:
+      print("Could not write index "+self.indexName+": "+str(err))
+
+
+  ###########################################
+
+  @property
+  def lon(self):
+    '''
+    Footprint centre longitudes, read from
+    the sidecar on first use
+    '''
+    if(self._lon is None):
+      self._lon=self.npz['lon']
+    return(self._lon)
+
+  @property
+  def lat(self):
+    '''
+    Footprint centre latitudes
+    '''
+    if(self._lat is None):
+      self._lat=self.npz['lat']
+    return(self._lat)
+
+
+  ###########################################
+
+  def cellOf(self,lon,lat):
+    '''
+    Grid cell number of each coordinate
+    '''
+    x0,y0,dX,dY,nX,nY=self.grid
+    iX=np.clip(((np.asarray(lon)-x0)/dX).astype(int),0,int(nX)-1)
+    iY=np.clip(((np.asarray(lat)-y0)/dY).astype(int),0,int(nY)-1)
+    return(iY*int(nX)+iX)
+
+
+  ###########################################
+
+  def shotRanges(self,minX,minY,maxX,maxY):
+    '''
+    First and one past the last shot of each run
+    of shots in the cells overlapping a box, in
+    shot order. A superset of the shots in the box
+    '''
+    x0,y0,dX,dY,nX,nY=self.grid
+    nX,nY=int(nX),int(nY)
+    if((self.nShots==0) or (maxX<self.bounds[0]) or (minX>self.bounds[2]) or (maxY<self.bounds[1]) or (minY>self.bounds[3])):
+      return(np.empty(0,dtype=int),np.empty(0,dtype=int))
+    iX0,iX1=[int(np.clip(np.floor((v-x0)/dX),0,nX-1)) for v in (minX,maxX)]
+    iY0,iY1=[int(np.clip(np.floor((v-y0)/dY),0,nY-1)) for v in (minY,maxY)]
+    cells=(np.arange(iY0,iY1+1)[:,np.newaxis]*nX+np.arange(iX0,iX1+1)).ravel()
+    runs=np.concatenate([np.arange(self.cellStart[c],self.cellStart[c+1]) for c in cells])
+    starts,ends=self.runStart[runs],self.runEnd[runs]
+    order=np.argsort(starts)
+    return(starts[order],ends[order])
+
+
+  ###########################################
+
+  def findInBounds(self,minX,minY,maxX,maxY):
+    '''
+    Indices of the footprints within a box, as
+    lvisClass.findInBounds, only testing the
+    shots in the cells overlapping the box
+    '''
+    starts,ends=self.shotRanges(minX,minY,maxX,maxY)
+    if(len(starts)==0):
+      return(np.empty(0,dtype=np.int64))
+    lengths=ends-starts
+    # every shot of every run
+    cand=np.repeat(starts-np.cumsum(lengths)+lengths,lengths)+np.arange(lengths.sum())
+    lon,lat=self.lon[cand],self.lat[cand]
+    return(cand[(lon>=minX)&(lon<maxX)&(lat>=minY)&(lat<maxY)])
+
+
+###########################################
+
+def indexPath(filename,indexDir=None):
+  '''
+  Where the sidecar of a file is kept
+  '''
+  if(indexDir is None):
+    indexDir=os.environ.get('LVIS_INDEX_DIR')
+  if(indexDir is None):
+    return(filename+'.idx.npz')
+  return(os.path.join(indexDir,os.path.basename(filename)+'.idx.npz'))
+
+
+###########################################
+
+if __name__=="__main__":
+  '''Main block'''
+  import sys
+  # build the sidecars of the files given
+  for filename in sys.argv[1:]:
+    index=lvisIndex(filename,rebuild=True)
+    print(filename,index.nShots,"shots, bounds",index.bounds,"to",index.indexName)
@@ -1,15 +1,21 @@
-import rasterio
 import glob
-from batch_process import get_image_filenames,generate_tiff
-from rasterio.merge import merge
+import sys
+from batch_process import get_image_filenames
+from stream_merge import stream_merge
 from merge_year import task3_merge
-import matplotlib.pyplot as plt
-from Connect_route import save_as_tiff,read_and_preprocess_tiff,connect_nearest_contours
+from Connect_route import fill_gaps_float
 from volume_analysis import volume_analysis
 
 
 if __name__=="__main__":
     
+    # With --mosaic, task1.py has already written each year straight in to
+    # ./task3/<year>final.tif, so neither merge is needed
+    use_mosaic = '--mosaic' in sys.argv
+
+    # How overlapping pixels are combined in both merges: first, last, mean, min or max
+    merge_method = 'first'
+
     root ='./tifs'
     dirs = get_image_filenames(root)
     # Get the keys of the dictionary in insertion order
@@ -18,6 +24,8 @@ if __name__=="__main__":
     if len(keys) >= 2:
       del dirs[keys[0]]
       del dirs[keys[1]]
+    if use_mosaic:
+      dirs = {}
 
     # This code chunk is used to merge tif files from every single hdf5 file
     # Loop over the folders containing tif files
@@ -34,33 +42,9 @@ if __name__=="__main__":
         tif_path = str(root + dir_folder + '/*.tif')
         tif_files = glob.glob(tif_path)
 
-        # Open each file and add them to a list
-        src_files_to_mosaic = [rasterio.open(fp) for fp in tif_files]
-
-        # Merge the files
-        mosaic, out_trans = merge(src_files_to_mosaic)
-
-        # Copy the metadata from one of the source files
-        out_meta = src_files_to_mosaic[0].meta.copy()
-
-        # Update the metadata with new dimensions, transform, and CRS
-        out_meta.update({
-            "driver": "GTiff",
-            "height": mosaic.shape[1],
-            "width": mosaic.shape[2],
-            "transform": out_trans,
-            "crs": src_files_to_mosaic[0].crs
-        })
-
-        # Write the image to a new file
+        # Merge the files block by block, only reading the files overlapping each block
         output_file = f'./output/{year}/merged_output{dir_folder}.tif'
-        with rasterio.open(output_file, 'w', **out_meta) as dest:
-            dest.write(mosaic)
-        print(f'Data saved to {output_file}')
-
-        # Close all files
-        for src in src_files_to_mosaic:
-            src.close()
+        stream_merge(tif_files, output_file, method=merge_method)
         
 
     input("\nPress enter to process task 3 and 4...\n")
@@ -69,23 +53,17 @@ if __name__=="__main__":
     for year in i: 
 
       # Process the all files in one year into a single file
-      task3_merge(year)
+      if not use_mosaic:
+        task3_merge(year, method=merge_method)
 
       # Call the gap filling methods
       print(f"Filling gaps in {year} data...")
       tiff_path = f"./task3/{year}final.tif"
-      img_8bit = read_and_preprocess_tiff(tiff_path)
-      result_img = connect_nearest_contours(img_8bit)
-
-      # Display the results
-      #cv2.imshow("Connected Flight Routes", result_img)
-      #cv2.waitKey(0)
-      #cv2.destroyAllWindows()
 
-      # Save as the result after connecting as a tif file
+      # Fill on the float elevations and save as a tif file, keeping real heights for task 5
       print(f"Saving connected data from{year}...")
       output_tiff_path = f"./connected_route/connected{year}.tif"
-      save_as_tiff(result_img, output_tiff_path, tiff_path)
+      fill_gaps_float(tiff_path, output_tiff_path)
       print(f"{year} data saved to {output_tiff_path}")
 
 
@@ -102,11 +80,11 @@ if __name__=="__main__":
     # Call the resampling method, ensuring two DEMs are in the same size and computable
     volume_analysis.resample_raster(dem_paths[1], dem_paths[0], "./task5/DEM2015_resampled.tif")
     
-    # Create an object for analysis
-    analyzer = volume_analysis(dem_paths[0], "./task5/DEM2015_resampled.tif")
+    # Create an object for analysis, streaming both DEMs block by block
+    analyzer = volume_analysis(dem_paths[0], "./task5/DEM2015_resampled.tif", windowed=True)
     
-    # Calculate and return the influence of glacier melt
-    analyzer.report_results()
+    # Generate the elevation variation file, which also works out the volume change
+    analyzer.save_elevation_difference_tiff(output_path)
     
-    # Generate the elevation variation file
-    analyzer.save_elevation_difference_tiff(output_path)
\ No newline at end of file
+    # Calculate and return the influence of glacier melt
+    analyzer.report_results()
\ No newline at end of file
@@ -1,10 +1,10 @@
 import os
 import glob
-import rasterio
-from rasterio.merge import merge
-from osgeo import gdal
+from stream_merge import stream_merge
+from metrics import timed
 
-def task3_merge(year):
+@timed("task3_merge", lambda year, *args, **kwargs: {"year": year})
+def task3_merge(year, method='first', block_size=1024):
     # path to the folder containing tif files
     in_path = str('./output/' + year + '/')
     out_path = './task3'
@@ -16,30 +16,12 @@ def task3_merge(year):
     if not input_files:
         raise FileNotFoundError(f"tif files not found, please check if the path {in_path} is right")
     
-    # read all tif files
-    files_mosaic = [rasterio.open(f) for f in input_files]
-    
-    # Merge
-    mosaic, out_trans = merge(files_mosaic)
-    
-    # Read and update metadata
-    out_meta = files_mosaic[0].meta.copy()
-    out_meta.update({"driver": "GTiff",
-                     "height": mosaic.shape[1],
-                     "width": mosaic.shape[2],
-                     "transform": out_trans})
-    
     # Output file
     out_name = str(year + "final.tif")
     out_file = os.path.join(out_path, out_name)
     
-    # Save output file
-    with rasterio.open(out_file, "w", **out_meta) as dest:
-        dest.write(mosaic)
-    
-    # Close all the opened files
-    for src in files_mosaic:
-        src.close()
+    # Merge block by block, keeping only one block and a few open files in RAM
+    stream_merge(input_files, out_file, method=method, block_size=block_size)
     
     # Reminder
     print(f"{year} data merge completed.")
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+import click
+
+
+# The JSON lines log of every stage. Kept in the environment, so worker processes log too
+ENV = 'LVIS_METRICS'
+
+def enable(log_path):
+    """ Start logging stages to log_path, in this process and any it starts """
+    os.environ[ENV] = os.path.abspath(log_path)
+
+def disable():
+    """ Stop logging stages """
+    os.environ.pop(ENV, None)
+
+def enabled():
+    return ENV in os.environ
+
+def peak_rss_mb():
+    """ Peak resident memory of this process so far, in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+@contextmanager
+def stage(name, **args):
+    """ Time a stage, logging its wall time and memory. Counts found while it runs,
+    such as waves, bytes_read or bytes_written, can be added to the yielded dict """
+    if not enabled():
+        yield {}
+        return
+    counts = dict(args)
+    start = time.time()
+    clock = time.perf_counter()
+    peak_before = peak_rss_mb()
+    try:
+        yield counts
+    finally:
+        log_event(name, start, time.perf_counter() - clock, counts, peak_before)
+
+def timed(name, counts=None):
+    """ Decorator to log every call of a function as a stage. counts is called with the
+    same arguments after the function returns, and gives a dict of counts to log """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with stage(name) as found:
+                result = func(*args, **kwargs)
+                if counts is not None:
+                    found.update(counts(*args, **kwargs))
+            return result
+        return wrapper
+    return decorate
+
+def log_event(name, start, seconds, counts, peak_before):
+    """ Append one stage to the log, as a single line so processes can share the file.
+    process_peak_rss_mb is the peak of the whole process so far, and peak_rise_mb how far
+    the stage raised it, which is 0 for a stage that stayed under an earlier peak """
+    if seconds > 0 and counts.get("waves"):
+        counts["waves_per_s"] = counts["waves"] / seconds
+    peak = peak_rss_mb()
+    event = {"name": name, "ts": start * 1e6, "dur": seconds * 1e6, "pid": os.getpid(),
+             "tid": threading.get_ident(), "process_peak_rss_mb": peak, "peak_rise_mb": peak - peak_before,
+             "args": counts}
+    with open(os.environ[ENV], 'a') as f:
+        f.write(json.dumps(event, default=plain) + '\n')
+
+def plain(value):
+    """ numpy numbers as python ones, anything else as text """
+    return value.item() if hasattr(value, 'item') else str(value)
+
+def file_size(path):
+    """ Size of a file in bytes, or 0 if it was not written """
+    return os.path.getsize(path) if path is not None and os.path.exists(path) else 0
+
+def read_log(log_path):
+    with open(log_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def chrome_trace(log_path, trace_path):
+    """ Convert the log to the Chrome trace format, for chrome://tracing, Perfetto or speedscope """
+    events = []
+    for event in read_log(log_path):
+        args = dict(event["args"], process_peak_rss_mb=event["process_peak_rss_mb"], peak_rise_mb=event["peak_rise_mb"])
+        events.append({"name": event["name"], "ph": "X", "ts": event["ts"], "dur": event["dur"],
+                       "pid": event["pid"], "tid": event["tid"], "args": args})
+    with open(trace_path, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def summarise(log_path):
+    """ Calls, total time, memory, bytes and waves/s of each stage. The memory is the largest
+    rise in the process peak over one call, and the process peak when the stage last ended """
+    summary = {}
+    for event in read_log(log_path):
+        entry = summary.setdefault(event["name"], {"calls": 0, "seconds": 0.0, "peak_rise_mb": 0.0, "process_peak_rss_mb": 0.0,
+                                                   "waves": 0, "bytes_read": 0, "bytes_written": 0})
+        entry["calls"] += 1
+        entry["seconds"] += event["dur"] / 1e6
+        entry["peak_rise_mb"] = max(entry["peak_rise_mb"], event["peak_rise_mb"])
+        entry["process_peak_rss_mb"] = max(entry["process_peak_rss_mb"], event["process_peak_rss_mb"])
+        for key in ("waves", "bytes_read", "bytes_written"):
+            entry[key] += event["args"].get(key, 0) or 0
+    for entry in summary.values():
+        entry["waves_per_s"] = entry["waves"] / entry["seconds"] if entry["waves"] and entry["seconds"] else None
+    return summary
+
+@click.command()
+@click.argument('log_path')
+@click.option('--chrome', 'trace_path', default=None, help='Also write a Chrome trace JSON file here.')
+def report(log_path, trace_path):
+    """ Print a summary of a metrics log """
+    summary = summarise(log_path)
+    print(f"{'stage':<26}{'calls':>7}{'seconds':>10}{'rise MB':>10}{'process MB':>11}{'MB read':>10}{'MB written':>11}{'waves/s':>12}")
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]["seconds"]):
+        waves = f"{entry['waves_per_s']:.0f}" if entry["waves_per_s"] else "-"
+        print(f"{name:<26}{entry['calls']:>7}{entry['seconds']:>10.3f}{entry['peak_rise_mb']:>10.1f}{entry['process_peak_rss_mb']:>11.1f}"
+              f"{entry['bytes_read'] / 1e6:>10.1f}{entry['bytes_written'] / 1e6:>11.1f}{waves:>12}")
+    if trace_path is not None:
+        chrome_trace(log_path, trace_path)
+        print(f"Chrome trace written to {trace_path}")
+
+if __name__=="__main__":
+    report()
@@ -0,0 +1,179 @@
+
+'''
+Write DEMs straight in to one tiled,
+compressed geotiff per year, on an EPSG:3031
+grid covering the input files, rather than one
+geotiff per tile that need merging afterwards
+'''
+
+###################################
+import os
+import uuid
+import shutil
+from glob import glob
+from functools import lru_cache
+import numpy as np
+from rasterio.windows import Window
+from rasterio.transform import from_origin
+from handleTiff import gridPoints
+from cogTiff import cogWriter
+from lvisClass import lvisData
+from transformCache import transformCoords
+
+
+###################################
+
+class demMosaic(object):
+  '''
+  A yearly mosaic on a grid covering the input
+  files. Each tile is gridded once in to a small
+  part file, which any process can write without
+  locking. finish() then combines the parts in one
+  pass in to a COG, where band 1 holds the mean
+  elevation and band 2 the number of footprints,
+  so tiles can be added in any order
+  '''
+
+  def __init__(self,filename,bounds,res=30,epsg=3031,blockSize=1024):
+    '''
+    Class initialiser. bounds (minX,minY,maxX,maxY)
+    in epsg are the extent of the grid, for example
+    from mosaicBounds(). Parts are kept in filename.parts
+    '''
+    self.filename=filename
+    self.res=res
+    self.minX,self.minY,self.maxX,self.maxY=bounds
+    self.epsg=epsg
+    self.blockSize=blockSize
+    # determine image size
+    self.nX=int(np.ceil((self.maxX-self.minX)/res))
+    self.nY=int(np.ceil((self.maxY-self.minY)/res))
+    self.transform=from_origin(self.minX,self.maxY,res,res)
+    self.partDir=filename+".parts"
+    os.makedirs(self.partDir,exist_ok=True)
+
+
+  ###########################################
+
+  def clear(self):
+    '''
+    Drop the parts of any earlier run
+    '''
+    shutil.rmtree(self.partDir,ignore_errors=True)
+    os.makedirs(self.partDir,exist_ok=True)
+
+
+  ###########################################
+
+  def addPoints(self,data,x,y,noData=-999.9):
+    '''
+    Grid points and save them as one part,
+    covering only the window of the mosaic
+    that they fall in. Raises a ValueError if
+    any point with data is outside the grid
+    '''
+    # calculate the raster pixel index in x and y
+    cols=np.array(np.floor((x-self.minX)/self.res),dtype=np.int64)
+    rows=np.array(np.floor((self.maxY-y)/self.res),dtype=np.int64)
+    hasData=data!=noData
+    inside=(cols>=0)&(cols<self.nX)&(rows>=0)&(rows<self.nY)
+    if(np.any(hasData&~inside)):
+      raise ValueError(str(np.count_nonzero(hasData&~inside))+" points are outside the mosaic "+self.filename+
+                       ", which covers "+str([self.minX,self.minY,self.maxX,self.maxY])+" in EPSG:"+str(self.epsg))
+    use=np.where(hasData)[0]
+    if(len(use)==0):
+      return
+
+    # window covering the points
+    c0,c1=np.min(cols[use]),np.max(cols[use])+1
+    r0,r1=np.min(rows[use]),np.max(rows[use])+1
+
+    # combine the footprints per pixel, relative to the window
+    cells,stats=gridPoints(data[use],(rows[use]-r0)*(c1-c0)+cols[use]-c0,("mean","count"))
+
+    # written under a temporary name, so finish() never sees half a part
+    partName=os.path.join(self.partDir,uuid.uuid4().hex)
+    with open(partName+".tmp",'wb') as f:
+      np.savez(f,window=np.array([r0,c0,r1-r0,c1-c0]),cells=cells,mean=stats["mean"],count=stats["count"])
+    os.replace(partName+".tmp",partName+".npz")
+    print("Tile added to",self.filename,"at rows",r0,"to",r1,"and columns",c0,"to",c1)
+
+
+  ###########################################
+
+  def finish(self,maxCached=64):
+    '''
+    Combine all the parts in to the mosaic, one block
+    at a time, so each block is written only once. Blocks
+    with no parts are not written. The parts are kept
+    until clear(), so finish() can be run again
+    '''
+    parts=sorted(glob(os.path.join(self.partDir,"*.npz")))
+    windows=np.zeros((len(parts),4),dtype=np.int64)
+    for i,part in enumerate(parts):
+      with np.load(part) as npz:
+        windows[i]=npz['window']
+
+    @lru_cache(maxsize=maxCached)
+    def loadPart(i):
+      # global row and column of each pixel of a part, with its mean and count
+      with np.load(parts[i]) as npz:
+        r0,c0,nR,nC=npz['window']
+        cells=npz['cells']
+        return(r0+cells//nC,c0+cells%nC,npz['mean'].astype(np.float64),npz['count'].astype(np.float64))
+
+    profile={"driver":"GTiff","width":self.nX,"height":self.nY,"count":2,"dtype":"float32",
+             "crs":"EPSG:"+str(self.epsg),"transform":self.transform,"nodata":-999.0}
+    with cogWriter(self.filename,**profile) as dst:
+      dst.set_band_description(1,"mean")
+      dst.set_band_description(2,"count")
+      for br0 in range(0,self.nY,self.blockSize):
+        br1=min(br0+self.blockSize,self.nY)
+        for bc0 in range(0,self.nX,self.blockSize):
+          bc1=min(bc0+self.blockSize,self.nX)
+          # parts overlapping this block
+          overlap=np.where((windows[:,0]<br1)&(windows[:,0]+windows[:,2]>br0)&
+                           (windows[:,1]<bc1)&(windows[:,1]+windows[:,3]>bc0))[0]
+          if(len(overlap)==0):
+            continue
+          total=np.zeros((br1-br0,bc1-bc0))
+          count=np.zeros((br1-br0,bc1-bc0))
+          for i in overlap:
+            rows,cols,mean,n=loadPart(i)
+            use=(rows>=br0)&(rows<br1)&(cols>=bc0)&(cols<bc1)
+            # weighted mean of the footprints of every part
+            np.add.at(total,(rows[use]-br0,cols[use]-bc0),mean[use]*n[use])
+            np.add.at(count,(rows[use]-br0,cols[use]-bc0),n[use])
+          hasData=count>0
+          mean=np.where(hasData,total/np.where(hasData,count,1),-999.0).astype(np.float32)
+          count=np.where(hasData,count,-999.0).astype(np.float32)
+          window=Window(bc0,br0,bc1-bc0,br1-br0)
+          dst.write(mean,1,window=window)
+          dst.write(count,2,window=window)
+    print("Mosaic of",len(parts),"parts written to",self.filename)
+    return(self.filename)
+
+
+###################################
+
+def mosaicBounds(filenames,res=30,epsg=3031,useIndex=False):
+  '''
+  Bounds in epsg of the footprints of all the files,
+  snapped outwards to whole pixels of res with a pixel
+  to spare, so mosaics of the same res line up
+  '''
+  minX=minY=np.inf
+  maxX=maxY=-np.inf
+  for filename in filenames:
+    b=lvisData(filename,onlyBounds=True,useIndex=useIndex)
+    if(len(b.lon)==0):
+      continue
+    x,y=transformCoords(b.lat,b.lon,epsg)   # lat/lon axis order for EPSG:4326
+    minX,minY=min(minX,np.min(x)),min(minY,np.min(y))
+    maxX,maxY=max(maxX,np.max(x)),max(maxY,np.max(y))
+  if(not np.isfinite(minX)):
+    raise ValueError("No footprints in the files to make a mosaic from")
+  return(((np.floor(minX/res)-1)*res,(np.floor(minY/res)-1)*res,(np.floor(maxX/res)+1)*res,(np.floor(maxY/res)+1)*res))
+
+
+###################################
@@ -1,7 +1,8 @@
-from pyproj import Proj, transform
+from transformCache import transformCoords
 from matplotlib import pyplot as plt
 from processLVIS import lvisGround
-from handleTiff import writeTiff
+from handleTiff import writeTiff, rasterAccumulator
+from metrics import timed, file_size
 
 
 
@@ -15,15 +16,12 @@ class plotLVIS(lvisGround):
 
   def reprojectBounds(self,outEPSG):
     '''A method to reproject the file bounds'''
-    # set projections
-    inProj=Proj("epsg:4326")
-    outProj=Proj("epsg:"+str(outEPSG))
-    # reproject data
-    self.bounds[0,2],self.bounds[1,3]=transform(inProj, outProj, self.bounds[0,2], self.bounds[1,3])
+    # reproject the corners of the bounds (lat/lon axis order for EPSG:4326)
+    _,_,self.bounds=transformCoords([],[],outEPSG,bounds=[self.bounds[1],self.bounds[0],self.bounds[3],self.bounds[2]])
 
   def inspectWaves(self):
     '''A method to preview the waves data in a single graph'''
-    plt.plot(self.waves,self.z)
+    plt.plot(self.waves,self.zAxis[:])
     plt.show()
 
   def plotWaves(self,outRoot="waveform",step=1):
@@ -36,16 +34,50 @@ class plotLVIS(lvisGround):
   def plotWave(self,i,outRoot="waveform"):
     ''''A method to plot a single waveform'''
     outName=outRoot+"."+str(i)+".png"
-    plt.plot(self.waves[i],self.z[i])
+    plt.plot(self.waves[i],self.zAxis[i])
     plt.xlabel("Waveform return")
     plt.ylabel("Elevation (m)")
     plt.savefig(outName)
     plt.close()
     print("Graph to",outName)
 
-  def writeDEM(self,res,outName):
-    '''Write LVIS ground elevation data to a geotiff'''
+  @timed("writeDEM",lambda self,res,outName,mosaic=None,epsg=3031:{"waves":self.nWaves,"bytes_written":file_size(outName),"tile":outName})
+  def writeDEM(self,res,outName,mosaic=None,epsg=3031):
+    '''Write LVIS ground elevation data to a geotiff in epsg,
+       or in to a demMosaic if one is given'''
+
+    # write straight in to the yearly mosaic
+    if(mosaic is not None):
+      mosaic.addPoints(self.zG,self.x,self.y)
+      return
 
     # call function from handletiff.py
-    writeTiff(self.zG,self.x,self.y,res,filename=outName,epsg=3031)
-    return
\ No newline at end of file
+    writeTiff(self.zG,self.x,self.y,res,filename=outName,epsg=epsg)
+    return
+
+  @classmethod
+  @timed("streamDEM",lambda cls,filename,res,outName,*args,**kwargs:{"bytes_read":file_size(filename),"bytes_written":file_size(outName)})
+  def streamDEM(cls,filename,res,outName,ramBudget=1e9,epsg=3031,mosaic=None,prefetch=0):
+    '''Write the ground of a whole file to a geotiff, one
+       block of shots at a time to stay within ramBudget bytes.
+       If a demMosaic is given, each block is written in to it instead.
+       prefetch reads that many blocks ahead while one is processed.
+       The budget covers the blocks, but not the raster, which holds
+       12 bytes per pixel of each 512x512 tile that footprints fall in'''
+
+    # write each block straight in to the yearly mosaic
+    if(mosaic is not None):
+      for block in cls.streamGround(filename,ramBudget=ramBudget,outEPSG=mosaic.epsg,prefetch=prefetch):
+        mosaic.addPoints(block.zG,block.x,block.y)
+        del block    # before the next block is read
+      return
+
+    # find the projected bounds a block at a time, to size the raster
+    raster=rasterAccumulator(cls.streamBounds(filename,ramBudget=ramBudget,outEPSG=epsg),res)
+
+    # add the ground of each block
+    for block in cls.streamGround(filename,ramBudget=ramBudget,outEPSG=epsg,prefetch=prefetch):
+      raster.add(block.zG,block.x,block.y)
+      del block    # before the next block is read
+    raster.write(filename=outName,epsg=epsg)
+    return
@@ -0,0 +1,178 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import click
+from batch_process import generate_tiff, RES, EPSG
+from stream_merge import stream_merge
+from merge_year import task3_merge
+from Connect_route import fill_gaps_float
+from volume_analysis import volume_analysis
+from metrics import enable
+
+
+MANIFEST = './pipeline_manifest.json'
+
+def file_hash(path, cache):
+    """ sha256 of a file's contents, only re-read when its size or modification time changes """
+    stat = os.stat(path)
+    key = [stat.st_size, stat.st_mtime_ns]
+    entry = cache.get(path)
+    if entry is not None and entry[:2] == key:
+        return entry[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    cache[path] = key + [digest.hexdigest()]
+    return cache[path][2]
+
+class Pipeline:
+    """ Runs stages only when their input hashes, parameters or outputs differ from the manifest """
+    def __init__(self, manifest_path=MANIFEST, force=False):
+        self.manifest_path = manifest_path
+        self.force = force
+        self.planned = set()
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        self.stages = manifest.get("stages", {})
+        self.hashes = manifest.get("hashes", {})
+
+    def stage(self, name, inputs, outputs, params, action):
+        """ Run action() unless the stage is up to date. Returns whether it ran """
+        self.planned.add(name)
+        record = {"inputs": {path: file_hash(path, self.hashes) for path in sorted(inputs)},
+                  "params": params, "outputs": sorted(outputs)}
+        if not self.force and self.stages.get(name) == record and all(os.path.exists(out) for out in outputs):
+            print(f"Up to date: {name}")
+            return False
+        print(f"Running: {name}")
+        action()
+        self.stages[name] = record
+        self.save()
+        return True
+
+    def prune(self, prefixes=("",)):
+        """ Delete the outputs of stages no longer in the pipeline, such as a removed flight """
+        for name in [name for name in self.stages if name not in self.planned and name.startswith(prefixes)]:
+            for out in self.stages.pop(name)["outputs"]:
+                if os.path.isdir(out):
+                    shutil.rmtree(out)
+                elif os.path.exists(out):
+                    os.remove(out)
+            print(f"Removed: {name}")
+        self.save()
+
+    def save(self):
+        """ Write the manifest, replacing the old one in one step so it is never half written """
+        self.hashes = {path: entry for path, entry in self.hashes.items() if os.path.exists(path)}
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"stages": self.stages, "hashes": self.hashes}, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+def flight_year(path):
+    """ The year of a flight, from its path """
+    return '2015' if '2015' in path else '2009'
+
+def run_pipeline(h5_files, workers=1, retries=2, merge_method='first', force=False, manifest_path=MANIFEST):
+    """ Build the DEMs, merges, gap filled DEMs and volume change, re-running only what changed """
+    pipe = Pipeline(manifest_path, force=force)
+    years = sorted({flight_year(h5) for h5 in h5_files})
+    # Only the stages of the years in this run are pruned, so a run of one year keeps the other's outputs
+    flight_stages = tuple(f"{kind}:{year}:" for year in years for kind in ("generate_tiff", "flight_merge"))
+
+    # The arguments that change the outputs are the stage parameters, so changing one reruns the stage
+    tiff_args = dict(ram_budget=None, mosaic=False, use_index=False, use_cache=False, prefetch=0, max_shots=None, metrics_log=None)
+    tiff_params = {"res": RES, "epsg": EPSG, "ram_budget": tiff_args["ram_budget"], "max_shots": tiff_args["max_shots"]}
+    fill_args = dict(tile_size=2048, kernel_size=19, line_thickness=15)
+
+    # HDF5 file to tif tiles, then the tiles of each flight in to one file
+    for h5 in sorted(h5_files):
+        year = flight_year(h5)
+        name = os.path.splitext(os.path.basename(h5))[0]
+        tile_dir = f'./tifs/{year}/{name}/'
+
+        def make_tiles(h5=h5, tile_dir=tile_dir):
+            # Clear old tiles first, so none are left over from an earlier run
+            shutil.rmtree(tile_dir, ignore_errors=True)
+            generate_tiff.callback(file_path=h5, workers=workers, retries=retries, **tiff_args)
+        pipe.stage(f"generate_tiff:{year}:{h5}", [h5], [tile_dir], tiff_params, make_tiles)
+
+        # A flight with no footprints has no tiles, and no merged file
+        tif_files = sorted(glob.glob(tile_dir + '*.tif'))
+        if not tif_files:
+            print(f"No tiles for {name}, not merging it")
+            continue
+        merged = f'./output/{year}/merged_output{name}.tif'
+        os.makedirs(os.path.dirname(merged), exist_ok=True)
+        pipe.stage(f"flight_merge:{year}:{name}", tif_files, [merged], {"method": merge_method},
+                   lambda tif_files=tif_files, merged=merged: stream_merge(tif_files, merged, method=merge_method))
+
+    # Before the yearly merge picks up the flight merges of removed files
+    pipe.prune(flight_stages)
+
+    # Each year in to one file, then fill the gaps
+    os.makedirs('./task3', exist_ok=True)
+    os.makedirs('./connected_route', exist_ok=True)
+    connected = {}
+    for year in years:
+        flights = glob.glob(f'./output/{year}/*.tif')
+        if not flights:
+            print(f"No merged flights for {year}, skipping its merge and gap filling")
+            continue
+        final = f'./task3/{year}final.tif'
+        pipe.stage(f"task3_merge:{year}", flights, [final], {"method": merge_method},
+                   lambda year=year: task3_merge(year, method=merge_method))
+
+        connected[year] = f'./connected_route/connected{year}.tif'
+        pipe.stage(f"connect:{year}", [final], [connected[year]], fill_args,
+                   lambda final=final, out=connected[year]: fill_gaps_float(final, out, **fill_args))
+
+    # Volume change between the two years, the later resampled on to the earlier
+    if len(connected) == 2:
+        os.makedirs('./task5', exist_ok=True)
+        resampled = f'./task5/DEM{years[1]}_resampled.tif'
+        change = './task5/elevation_change.tif'
+        results = './task5/volume_results.json'
+
+        def volume():
+            volume_analysis.resample_raster(connected[years[1]], connected[years[0]], resampled)
+            analyzer = volume_analysis(connected[years[0]], resampled, windowed=True)
+            analyzer.save_elevation_difference_tiff(change)
+            volume_change, Sea_level_change, valid_pixels = analyzer.results
+            with open(results, 'w') as f:
+                json.dump({"volume_change": volume_change, "sea_level_change": Sea_level_change, "valid_pixels": valid_pixels}, f)
+        pipe.stage("volume", [connected[year] for year in years], [resampled, change, results], {"windowed": True}, volume)
+
+        with open(results) as f:
+            report = json.load(f)
+        print(f"Total volume variation: {report['volume_change']:.2f} m³")
+        print(f"Estimated sea level variation: {report['sea_level_change']:.2f} cm")
+
+    # Stages of this run's years that were not planned, such as the merge of a year with no flights left.
+    # The volume is only pruned by a run of both years that could not make it
+    year_stages = tuple(f"{kind}:{year}" for year in years for kind in ("task3_merge", "connect"))
+    pipe.prune(flight_stages + year_stages + (("volume",) if len(years) == 2 else ()))
+
+@click.command()
+@click.option('--file-path', 'file_paths', required=True, multiple=True, help='Path to the HDF5 files to process, may be given once per year.')
+@click.option('--workers', default=1, show_default=True, help='Number of processes to spread the tiles over.')
+@click.option('--retries', default=2, show_default=True, help='Times to retry a failed tile when running in parallel.')
+@click.option('--merge-method', 'merge_method', default='first', show_default=True, help='How overlapping pixels are combined: first, last, mean, min or max.')
+@click.option('--force', is_flag=True, help='Re-run every stage, ignoring the manifest.')
+@click.option('--metrics', 'metrics_log', default=None, help='Log the time, memory and data of every stage and tile to this JSON lines file.')
+@click.option('--manifest', 'manifest_path', default=MANIFEST, show_default=True, help='Where the record of each stage is kept.')
+def pipeline(file_paths, workers, retries, merge_method, force, metrics_log, manifest_path):
+    if metrics_log is not None:
+        enable(metrics_log)
+    h5_files = sorted({h5 for file_path in file_paths for h5 in glob.glob(file_path)})
+    if not h5_files:
+        raise click.ClickException("No HDF5 files found")
+    run_pipeline(h5_files, workers, retries, merge_method, force, manifest_path)
+
+if __name__=="__main__":
+    pipeline()
@@ -0,0 +1,83 @@
+""" Overlap reading, processing and writing: load the next tile or file in a background
+thread while the current one is processed, and write the results from another """
+import queue
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_ahead(items, load, depth=1):
+    """ Yield (item, load(item)) for each item, with the next depth items loading in a
+    background thread while the current one is used. Errors are raised in order, where
+    the item that failed would have been yielded """
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="read_ahead") as pool:
+        try:
+            for item in islice(items, depth):
+                pending.append((item, pool.submit(load, item)))
+            while pending:
+                item, future = pending.popleft()
+                # start on the next one before handing this one out
+                for following in islice(items, 1):
+                    pending.append((following, pool.submit(load, following)))
+                yield item, future.result()
+        finally:
+            # stopped early, so drop what has not started
+            for _, future in pending:
+                future.cancel()
+
+
+class BackgroundWriter:
+    """ Run writes one at a time in a background thread, in the order they are given.
+    At most max_pending writes wait in the queue, and submitting another blocks until
+    one is done, so the data waiting to be written stays bounded """
+
+    def __init__(self, max_pending=1):
+        self.queue = queue.Queue(maxsize=max(1, max_pending))
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            # after a failure the rest are drained unwritten, so submit never blocks for good
+            if self.error is not None:
+                continue
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except BaseException as err:
+                self.error = err
+
+    def check(self):
+        """ Raise the error of a failed write, if any """
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue func(*args, **kwargs), waiting for room in the queue """
+        self.check()
+        self.queue.put((func, args, kwargs))
+
+    def close(self):
+        """ Wait for every queued write to finish, then raise any error """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # already failing, so finish the writes without hiding the first error
+            self.queue.put(None)
+            self.thread.join()
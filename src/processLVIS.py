@@ -6,8 +6,12 @@ Some example functions for processing LVIS data
 #######################################
 
 import numpy as np
-from lvisClass import lvisData
-from pyproj import Proj, transform
+from itertools import product
+from lvisClass import lvisData,readCentres
+from lvisCache import openLVIS
+from transformCache import transformCoords
+from metrics import timed
+from prefetch import read_ahead
 from scipy.ndimage.filters import gaussian_filter1d 
  
 
@@ -15,16 +19,32 @@ from scipy.ndimage.filters import gaussian_filter1d
 
 class lvisGround(lvisData):
   '''
-  LVIS class with extra processing steps
+  LVIS class with extra processing steps.
+  With precision="float32" the waves stay in
+  their stored integer type and the noise stats,
+  smoothing and centre of gravity are done in
+  float32, in reused buffers. The default float64
+  path truncates the denoised waves to integers,
+  which float32 does not, so zG differs from it
+  by less than half a range bin (at most 0.14 m
+  with the 0.3 m bins of synthLVIS files)
   '''
+  precision="float64"
 
   #######################################################
 
-  def estimateGround(self,threshScale=5,statsLen=10,minWidth=3,smooWidth=0.5):
+  @timed("estimateGround",lambda self,*args,**kwargs:{"waves":self.nWaves})
+  def estimateGround(self,threshScale=5,statsLen=10,minWidth=3,smooWidth=0.5,precision=None):
     '''
     Processes waveforms to estimate ground
     Only works for bare Earth. DO NOT USE IN TREES
+    precision is "float64" (the default) or "float32"
     '''
+    if(precision is not None):
+      if(precision not in ("float64","float32")):
+        raise ValueError("precision must be float64 or float32, not "+str(precision))
+      self.precision=precision
+
     # find noise statistics
     self.findStats(statsLen=statsLen)
 
@@ -38,6 +58,137 @@ class lvisGround(lvisData):
     self.CofG()
 
 
+  #######################################################
+
+  @timed("sweepGround",lambda self,params,*args,**kwargs:{"waves":self.nWaves,"sets":len(params)})
+  def sweepGround(self,params,blockSize=4096,precision=None):
+    '''
+    Estimate the ground for many parameter sets in one
+    pass over the waveforms. params is a list of dicts of
+    estimateGround() arguments (threshScale, statsLen,
+    minWidth, smooWidth), missing ones taking the defaults,
+    such as made by parameterGrid(). The noise stats are
+    found once per statsLen and the thresholded waves
+    once per threshold and block, then shared by every
+    set using them. Returns an array of zG, one row per
+    set, each the same as estimateGround() would give
+    '''
+    if(precision is not None):
+      if(precision not in ("float64","float32")):
+        raise ValueError("precision must be float64 or float32, not "+str(precision))
+      self.precision=precision
+    float32=self.precision=="float32"
+    res=self.zAxis.res()
+    zG=np.full((len(params),self.nWaves),-999.9)  # no data flag for now
+
+    # group the sets by statsLen, then threshScale, then smooWidth
+    defaults={"threshScale":5,"statsLen":10,"minWidth":3,"smooWidth":0.5}
+    groups={}
+    for i,param in enumerate(params):
+      unknown=set(param)-set(defaults)
+      if(len(unknown)>0):
+        raise ValueError("Unknown parameters "+str(sorted(unknown)))
+      param=dict(defaults,**param)
+      # minWidth is not used by denoise(), so sets differing only by it share a zG
+      groups.setdefault(param["statsLen"],{}).setdefault(param["threshScale"],{}).setdefault(param["smooWidth"],[]).append(i)
+
+    # noise stats and thresholds once for all waveforms
+    stats,thresholds={},{}
+    for statsLen,threshGroups in groups.items():
+      stats[statsLen]=noiseStats(self.waves,int(statsLen/res),float32)
+      for threshScale in threshGroups:
+        thresholds[statsLen,threshScale]=stats[statsLen][0]+threshScale*stats[statsLen][1]
+
+    # work buffers, reused across blocks
+    if(float32):
+      nBlock=min(blockSize,self.nWaves)
+      base=np.empty((nBlock,self.nBins),dtype=np.float32)
+      cut=np.empty((nBlock,self.nBins),dtype=np.float32)
+      smoothed=np.empty((nBlock,self.nBins),dtype=np.float32)
+
+    # loop over blocks of waves
+    for i0 in range(0,self.nWaves,blockSize):
+      i1=min(i0+blockSize,self.nWaves)
+      for statsLen,threshGroups in groups.items():
+        meanNoise=stats[statsLen][0][i0:i1]
+        blockBase=subtractNoise(self.waves[i0:i1],meanNoise,base[:i1-i0] if float32 else None)
+        for threshScale,smooGroups in threshGroups.items():
+          # the thresholded waves, shared by every smoothing width
+          if(float32):
+            blockCut=cut[:i1-i0]
+            np.copyto(blockCut,blockBase)
+          else:
+            blockCut=blockBase.copy()
+          cutNoise(blockCut,thresholds[statsLen,threshScale][i0:i1])
+          for smooWidth,sets in smooGroups.items():
+            weights=gaussian_filter1d(blockCut,smooWidth/res,axis=1,output=smoothed[:i1-i0] if float32 else None)
+            groundBlock(weights,self.zAxis,i0,zG[sets[0]],float32)
+            zG[sets[1:],i0:i1]=zG[sets[0],i0:i1]
+    return(zG)
+
+
+  #######################################################
+
+  @classmethod
+  def streamGround(cls,filename,ramBudget=1e9,outEPSG=3031,prefetch=0,**groundArgs):
+    '''
+    Loop over a whole file in blocks of shots,
+    sized to fit within ramBudget bytes, yielding
+    each block with its ground found and reprojected.
+    Each block reads its own coordinates, so nothing
+    the size of the whole file is held. Callers should
+    drop each block before asking for the next, or
+    two are held at once. prefetch reads that many blocks ahead in a
+    background thread, while the current one is processed.
+    groundArgs are passed to estimateGround()
+    '''
+    f=openLVIS(filename)
+    blocks=None
+    try:
+      nWaves,nBins=f['RXWAVE'].shape
+      denoisedSize=4 if groundArgs.get('precision')=="float32" else 8
+      nShots=blockShots(nBins,f['RXWAVE'].dtype.itemsize,ramBudget,denoisedSize=denoisedSize,prefetch=prefetch)
+      # loop over blocks of consecutive shots, each reading only its own coordinates
+      ranges=(np.arange(start,min(start+nShots,nWaves)) for start in range(0,nWaves,nShots))
+      if(prefetch>0):
+        blocks=read_ahead(ranges,lambda useInd:cls.fromSource(f,useInd),prefetch)
+      else:
+        blocks=((useInd,cls.fromSource(f,useInd)) for useInd in ranges)
+      for useInd,block in blocks:
+        block.estimateGround(**groundArgs)
+        block.reprojectLVIS(outEPSG)
+        yield(block)
+        del block    # so only one block is held while the next is read
+    finally:
+      # stop reading ahead before the file is closed
+      if(blocks is not None):
+        blocks.close()
+      f.close()
+
+
+  #######################################################
+
+  @classmethod
+  def streamBounds(cls,filename,ramBudget=1e9,outEPSG=3031):
+    '''
+    Bounds (minX,minY,maxX,maxY) in outEPSG of the
+    footprint centres of a whole file, reading the
+    coordinates in blocks the size streamGround() uses
+    '''
+    f=openLVIS(filename)
+    try:
+      nWaves,nBins=f['RXWAVE'].shape
+      nShots=blockShots(nBins,f['RXWAVE'].dtype.itemsize,ramBudget)
+      bounds=[np.inf,np.inf,-np.inf,-np.inf]
+      for start in range(0,nWaves,nShots):
+        lon,lat=readCentres(f,nBins,np.arange(start,min(start+nShots,nWaves)))
+        x,y=transformCoords(lat,lon,outEPSG)   # lat/lon axis order for EPSG:4326
+        bounds=[min(bounds[0],np.min(x)),min(bounds[1],np.min(y)),max(bounds[2],np.max(x)),max(bounds[3],np.max(y))]
+    finally:
+      f.close()
+    return(bounds)
+
+
   #######################################################
 
   def setThreshold(self,threshScale):
@@ -50,7 +201,8 @@ class lvisGround(lvisData):
 
   #######################################################
 
-  def CofG(self):
+  @timed("CofG",lambda self,*args,**kwargs:{"waves":self.nWaves})
+  def CofG(self,blockSize=4096):
     '''
     Find centre of gravity of denoised waveforms
     '''
@@ -58,76 +210,193 @@ class lvisGround(lvisData):
     # allocate space for ground elevation
     self.zG=np.full(self.nWaves,-999.9)  # no data flag for now
 
-    # loop over waveforms
-    for i in range(0,self.nWaves):
-      if(np.sum(self.denoised[i])>0.0):   # avoid empty waveforms (clouds etc)
-        self.zG[i]=np.average(self.z[i],weights=self.denoised[i])  # centre of gravity
+    # loop over blocks of waveforms
+    for i0 in range(0,self.nWaves,blockSize):
+      i1=min(i0+blockSize,self.nWaves)
+      groundBlock(self.denoised[i0:i1],self.zAxis,i0,self.zG,self.precision=="float32")
 
   #######################################################
 
-  def reprojectLVIS(self,outEPSG):
-    '''A method to reproject the footprint coordinates'''
-    # set projections
-    inProj=Proj("epsg:4326")
-    outProj=Proj("epsg:"+str(outEPSG))
-    # reproject data
-    self.x,self.y=transform(inProj, outProj, self.lat, self.lon)
+  @timed("reprojectLVIS",lambda self,*args,**kwargs:{"waves":self.nWaves})
+  def reprojectLVIS(self,outEPSG,bounds=None):
+    '''A method to reproject the footprint coordinates.
+       If tile bounds (minX,minY,maxX,maxY in lon/lat) are given,
+       they are reprojected in the same call to self.projBounds'''
+    # reproject data with a cached transformer
+    if(bounds is None):
+      self.x,self.y=transformCoords(self.lat,self.lon,outEPSG)
+    else:
+      # lat/lon axis order for EPSG:4326
+      self.x,self.y,self.projBounds=transformCoords(self.lat,self.lon,outEPSG,bounds=[bounds[1],bounds[0],bounds[3],bounds[2]])
 
 
   ##############################################
 
+  @timed("findStats",lambda self,*args,**kwargs:{"waves":self.nWaves})
   def findStats(self,statsLen=10):
     '''
     Finds standard deviation and mean of noise
     '''
 
-    # make empty arrays
-    self.meanNoise=np.empty(self.nWaves)
-    self.stdevNoise=np.empty(self.nWaves)
-
     # determine number of bins to calculate stats over
-    res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
+    res=self.zAxis.res()    # range resolution
     noiseBins=int(statsLen/res)   # number of bins within "statsLen"
 
-    # loop over waveforms
-    for i in range(0,self.nWaves):
-      self.meanNoise[i]=np.mean(self.waves[i,0:noiseBins])
-      self.stdevNoise[i]=np.std(self.waves[i,0:noiseBins])
+    # all waveforms at once
+    self.meanNoise,self.stdevNoise=noiseStats(self.waves,noiseBins,self.precision=="float32")
 
 
   ##############################################
 
-  def denoise(self,threshold,smooWidth=0.5,minWidth=3):
+  @timed("denoise",lambda self,*args,**kwargs:{"waves":self.nWaves})
+  def denoise(self,threshold,smooWidth=0.5,minWidth=3,blockSize=4096):
     '''
     Denoise waveform data
     '''
 
     # find resolution
-    res=(self.z[0,0]-self.z[0,-1])/self.nBins    # range resolution
+    res=self.zAxis.res()    # range resolution
+
+    # float32, smoothing straight in to the output and reusing one work buffer
+    if(self.precision=="float32"):
+      self.denoised=np.empty((self.nWaves,self.nBins),dtype=np.float32)
+      buf=np.empty((min(blockSize,self.nWaves),self.nBins),dtype=np.float32)
+      for i0 in range(0,self.nWaves,blockSize):
+        i1=min(i0+blockSize,self.nWaves)
+        denoiseBlock(self.waves[i0:i1],self.meanNoise[i0:i1],threshold[i0:i1],res,smooWidth,out=self.denoised[i0:i1],buf=buf[:i1-i0])
+      return
 
     # make array for output
     self.denoised=np.full((self.nWaves,self.nBins),0)
 
-    # loop over waves
-    for i in range(0,self.nWaves):
-      #print("Denoising wave",i+1,"of",self.nWaves)
+    # loop over blocks of waves, to bound the size of temporary arrays
+    for i0 in range(0,self.nWaves,blockSize):
+      i1=min(i0+blockSize,self.nWaves)
+      self.denoised[i0:i1]=denoiseBlock(self.waves[i0:i1],self.meanNoise[i0:i1],threshold[i0:i1],res,smooWidth)
+
+
+#############################################################
+
+def parameterGrid(**values):
+  '''
+  Every combination of the values given for each
+  estimateGround() argument, as a list of dicts for
+  sweepGround(), e.g. parameterGrid(threshScale=[3,4,5],statsLen=[10,20])
+  '''
+  names=list(values)
+  return([dict(zip(names,combo)) for combo in product(*[np.atleast_1d(values[name]).tolist() for name in names])])
+
+
+#############################################################
+
+def blockShots(nBins,itemsize,ramBudget,blockSize=4096,denoisedSize=8,prefetch=0):
+  '''
+  Number of shots that can be processed
+  at once within ramBudget bytes, with
+  prefetch more blocks being read meanwhile
+  '''
+  tempBytes=48*blockSize*nBins       # temporary arrays in denoise() and CofG()
+  # per shot: the four coordinates read, centres, projected centres,
+  # ids, top and bottom elevations, noise statistics and ground
+  arrayBytes=160
+  shotBytes=(itemsize+denoisedSize)*nBins+arrayBytes    # waves, denoised and the per shot arrays
+  shotBytes+=prefetch*(itemsize*nBins+arrayBytes)       # the blocks read ahead
+  nShots=int((ramBudget-tempBytes)//shotBytes)
+  if(nShots<1):
+    raise ValueError("A RAM budget of "+str(ramBudget)+" bytes is too small for "+str(nBins)+" bins")
+  return(nShots)
+
 
-      # subtract mean background noise
-      self.denoised[i]=self.waves[i]-self.meanNoise[i]
+#############################################################
 
-      # set all values less than threshold to zero
-      self.denoised[i,self.denoised[i]<threshold[i]]=0.0
+def denoiseBlock(waves,meanNoise,threshold,res,smooWidth=0.5,out=None,buf=None):
+  '''
+  Denoise a 2D block of waveforms at once.
+  Gives the same answer as looping over
+  the waveforms one at a time. Given a float32
+  work buffer, buf, it works in float32 without
+  truncating and smooths in to out
+  '''
+  # subtract mean background noise
+  denoised=subtractNoise(waves,meanNoise,buf)
 
-      # minimum acceptable width
-      binList=np.where(self.denoised[i]>0.0)[0]
-      for j in range(0,binList.shape[0]):       # loop over waveforms
-        if((j>0)&(j<(binList.shape[0]-1))):    # are we in the middle of the array?
-          if((binList[j]!=binList[j-1]+1)|(binList[j]!=binList[j+1]-1)):  # are the bins consecutive?
-            self.denoised[i,binList[j]]=0.0   # if not, set to zero
+  # set all values less than threshold to zero and remove isolated signal bins
+  cutNoise(denoised,threshold)
 
-      # smooth
-      self.denoised[i]=gaussian_filter1d(self.denoised[i],smooWidth/res)
+  # smooth
+  return(gaussian_filter1d(denoised,smooWidth/res,axis=1,output=out))
 
 
 #############################################################
 
+def subtractNoise(waves,meanNoise,buf=None):
+  '''
+  Waves less their mean noise, in to the
+  float32 buffer buf if given, otherwise
+  truncated to integers, as before
+  '''
+  if(buf is not None):
+    return(np.subtract(waves,meanNoise[:,np.newaxis],out=buf))
+  denoised=np.empty(waves.shape,dtype=int)
+  denoised[:]=waves-meanNoise[:,np.newaxis]
+  return(denoised)
+
+
+#############################################################
+
+def cutNoise(denoised,threshold):
+  '''
+  Zero the bins below the threshold,
+  and then isolated signal bins, in place
+  '''
+  denoised[denoised<threshold[:,np.newaxis]]=0
+  isolatedBins(denoised)
+
+
+#############################################################
+
+def noiseStats(waves,noiseBins,float32=False):
+  '''
+  Mean and standard deviation of the
+  first noiseBins bins of each waveform
+  '''
+  dtype=np.float32 if float32 else None
+  return(np.mean(waves[:,0:noiseBins],axis=1,dtype=dtype),np.std(waves[:,0:noiseBins],axis=1,dtype=dtype))
+
+
+#############################################################
+
+def groundBlock(weights,zAxis,i0,zG,float32=False):
+  '''
+  Centre of gravity of a block of denoised
+  waveforms starting at shot i0, in to zG.
+  Waveforms with no signal are left as they are
+  '''
+  total=np.sum(weights,axis=1,dtype=np.float64)
+  use=np.where(total>0.0)[0]      # avoid empty waveforms (clouds etc)
+  if(float32):
+    # float32 weights against bin numbers, a matrix-vector product with no big temporaries
+    binPos=(weights@np.arange(weights.shape[1],dtype=np.float32))[use]/total[use]
+    zG[i0+use]=zAxis.at(i0+use,binPos)
+  else:
+    zG[i0+use]=np.sum(zAxis[i0+use]*weights[use],axis=1)/total[use]  # centre of gravity
+
+
+#############################################################
+
+def isolatedBins(denoised):
+  '''
+  Zero signal bins without signal either side.
+  The first and last signal bins in each waveform
+  are always kept
+  '''
+  signal=denoised>0.0
+  nSig=np.cumsum(signal,axis=1)
+  middle=((nSig-signal)>0)&(nSig<nSig[:,-1:])   # signal both before and after
+  # are both neighbours signal?
+  consec=np.zeros(signal.shape,dtype=bool)
+  consec[:,1:-1]=signal[:,:-2]&signal[:,2:]
+  denoised[signal&middle&~consec]=0
+
+
+#############################################################
@@ -1,4 +1,4 @@
-from pyproj import Proj, transform
+from transformCache import transformCoords
 from matplotlib import pyplot as plt
 from processLVIS import lvisGround
 from handleTiff import writeTiff
@@ -15,15 +15,12 @@ class plotLVIS(lvisGround):
 
   def reprojectBounds(self,outEPSG):
     '''A method to reproject the file bounds'''
-    # set projections
-    inProj=Proj("epsg:4326")
-    outProj=Proj("epsg:"+str(outEPSG))
-    # reproject data
-    self.bounds[0,2],self.bounds[1,3]=transform(inProj, outProj, self.bounds[0,2], self.bounds[1,3])
+    # reproject the corners of the bounds (lat/lon axis order for EPSG:4326)
+    _,_,self.bounds=transformCoords([],[],outEPSG,bounds=[self.bounds[1],self.bounds[0],self.bounds[3],self.bounds[2]])
 
   def inspectWaves(self):
     '''A method to preview the waves data in a single graph'''
-    plt.plot(self.waves,self.z)
+    plt.plot(self.waves,self.zAxis[:])
     plt.show()
 
   def plotWaves(self,outRoot="waveform",step=1):
@@ -36,7 +33,7 @@ class plotLVIS(lvisGround):
   def plotWave(self,i,outRoot="waveform"):
     ''''A method to plot a single waveform'''
     outName=outRoot+"."+str(i)+".png"
-    plt.plot(self.waves[i],self.z[i])
+    plt.plot(self.waves[i],self.zAxis[i])
     plt.xlabel("Waveform return")
     plt.ylabel("Elevation (m)")
     plt.savefig(outName)
@@ -0,0 +1,155 @@
+import math
+import numpy as np
+import rasterio
+from collections import OrderedDict
+from rasterio import windows
+from rasterio.transform import from_origin
+from metrics import timed, file_size
+from cogTiff import cogWriter
+
+METHODS = ('first', 'last', 'mean', 'min', 'max')
+
+def merge_grid(input_files):
+    """ Work out the output grid from the file headers only, as rasterio's merge does """
+    bounds = []
+    for path in input_files:
+        with rasterio.open(path) as src:
+            bounds.append(tuple(src.bounds))
+            if len(bounds) == 1:
+                # Take the resolution and metadata from the first file
+                res = src.res
+                meta = src.meta.copy()
+    bounds = np.array(bounds)
+
+    # Union of all the bounds
+    left, bottom = bounds[:, 0].min(), bounds[:, 1].min()
+    right, top = bounds[:, 2].max(), bounds[:, 3].max()
+    meta.update({"driver": "GTiff",
+                 "height": int(round((top - bottom) / res[1])),
+                 "width": int(round((right - left) / res[0])),
+                 "transform": from_origin(left, top, res[0], res[1])})
+    return meta, bounds
+
+def win_align(window):
+    """ Round a window's offsets and lengths to whole pixels, in the same way as rasterio's merge """
+    return windows.Window(math.floor(window.col_off + 0.1), math.floor(window.row_off + 0.1),
+                          math.floor(window.width + 0.5), math.floor(window.height + 0.5))
+
+class SourceCache:
+    """ Keep a limited number of input files open, closing the least recently used """
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.open_files = OrderedDict()
+
+    def get(self, path):
+        if path in self.open_files:
+            self.open_files.move_to_end(path)
+        else:
+            if len(self.open_files) >= self.max_open:
+                _, oldest = self.open_files.popitem(last=False)
+                oldest.close()
+            self.open_files[path] = rasterio.open(path)
+        return self.open_files[path]
+
+    def close(self):
+        for src in self.open_files.values():
+            src.close()
+        self.open_files.clear()
+
+@timed("stream_merge", lambda input_files, out_file, *args, **kwargs: {
+    "inputs": len(input_files), "bytes_read": sum(map(file_size, input_files)), "bytes_written": file_size(out_file)})
+def stream_merge(input_files, out_file, method='first', block_size=1024, max_open=64):
+    """ Merge geotiffs block by block, so RAM scales with the block size rather than the mosaic size """
+    if method not in METHODS:
+        raise ValueError(f"Unknown merge method {method}, choose from {METHODS}")
+    if not input_files:
+        raise FileNotFoundError("No files to merge")
+
+    meta, bounds = merge_grid(input_files)
+    out_transform = meta["transform"]
+    out_bounds = windows.bounds(windows.Window(0, 0, meta["width"], meta["height"]), out_transform)
+
+    # Blocks that are never written take no space until the COG is made
+    cache = SourceCache(max_open)
+    placements = {}
+    try:
+        with cogWriter(out_file, **meta) as dest:
+            for block in windows.subdivide(windows.Window(0, 0, meta["width"], meta["height"]), block_size, block_size):
+                # Only the inputs overlapping this block are read
+                b_left, b_bottom, b_right, b_top = windows.bounds(block, out_transform)
+                overlap = np.where((bounds[:, 0] < b_right) & (bounds[:, 2] > b_left) &
+                                   (bounds[:, 1] < b_top) & (bounds[:, 3] > b_bottom))[0]
+                if len(overlap) == 0:
+                    continue
+                sources = [cache.get(input_files[i]) for i in overlap]
+                for i, src in zip(overlap, sources):
+                    if i not in placements:
+                        placements[i] = place(src, out_bounds, out_transform)
+                data = merge_block(sources, [placements[i] for i in overlap], block, meta, method)
+                dest.write(data, window=block)
+    finally:
+        cache.close()
+    print(f'Data saved to {out_file}')
+    return out_file
+
+def place(src, out_bounds, out_transform):
+    """ Where an input goes in the whole output, as rasterio's merge places it when the output is one block:
+    its window in the input and its window, rounded once to whole pixels, in the output. None if it is outside """
+    w, s = max(src.bounds.left, out_bounds[0]), max(src.bounds.bottom, out_bounds[1])
+    e, n = min(src.bounds.right, out_bounds[2]), min(src.bounds.top, out_bounds[3])
+    if w >= e or s >= n:
+        return None
+    return windows.from_bounds(w, s, e, n, src.transform), win_align(windows.from_bounds(w, s, e, n, out_transform))
+
+def merge_block(sources, placements, block, meta, method):
+    """ Combine the overlapping inputs within one output block. Each input's part of the block is read from the
+    matching part of its window, so the output is the same whatever the block size """
+    shape = (meta["count"], block.height, block.width)
+    nodata = meta["nodata"] if meta["nodata"] is not None else 0
+    out = np.full(shape, nodata, dtype=meta["dtype"])
+    filled = np.zeros(shape, dtype=bool)
+    if method == 'mean':
+        total = np.zeros(shape)
+        n = np.zeros(shape, dtype=np.int32)
+
+    for src, placement in zip(sources, placements):
+        if placement is None:
+            continue
+        src_window, out_window = placement
+        # Intersection of the input's output window and the block, in whole pixels
+        r0, r1 = max(out_window.row_off, block.row_off), min(out_window.row_off + out_window.height, block.row_off + block.height)
+        c0, c1 = max(out_window.col_off, block.col_off), min(out_window.col_off + out_window.width, block.col_off + block.width)
+        if r0 >= r1 or c0 >= c1:
+            continue
+        # The same part of the input window, in input pixels
+        y_scale = src_window.height / out_window.height
+        x_scale = src_window.width / out_window.width
+        sub_window = windows.Window(src_window.col_off + (c0 - out_window.col_off) * x_scale,
+                                    src_window.row_off + (r0 - out_window.row_off) * y_scale,
+                                    (c1 - c0) * x_scale, (r1 - r0) * y_scale)
+        data = src.read(out_shape=(meta["count"], r1 - r0, c1 - c0), window=sub_window, masked=True)
+        valid = ~np.ma.getmaskarray(data)
+        data = data.data
+        rows = slice(r0 - block.row_off, r1 - block.row_off)
+        cols = slice(c0 - block.col_off, c1 - block.col_off)
+
+        if method == 'mean':
+            total[:, rows, cols][valid] += data[valid]
+            n[:, rows, cols][valid] += 1
+            continue
+        region = out[:, rows, cols]
+        seen = filled[:, rows, cols]
+        if method == 'first':
+            use = valid & ~seen
+        elif method == 'last':
+            use = valid
+        elif method == 'max':
+            use = valid & (~seen | (data > region))
+        else:
+            use = valid & (~seen | (data < region))
+        region[use] = data[use]
+        seen |= valid
+
+    if method == 'mean':
+        out[n > 0] = (total[n > 0] / n[n > 0]).astype(meta["dtype"])
+    return out
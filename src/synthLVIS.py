@@ -0,0 +1,86 @@
+
+'''
+Make synthetic LVIS files, laid
+out like the real ones, for
+benchmarking and trying things out
+'''
+
+###################################
+import numpy as np
+import h5py
+
+
+###################################
+
+def makeLVIS(filename,nShots=100000,nBins=500,nLines=4,binRes=0.3,dZ=0.0,seed=0,blockSize=8192,lon0=260.0,lat0=-75.5):
+  '''
+  Write a synthetic LVIS file of nShots waveforms
+  of nBins bins, along nLines parallel flight lines
+  with gaps between them. Each waveform has a
+  gaussian ground return on noise. dZ shifts the
+  whole surface, to mimic a change between years
+  '''
+  rng=np.random.default_rng(seed)
+  f=h5py.File(filename,'w')
+  waves=f.create_dataset('RXWAVE',(nShots,nBins),dtype=np.uint16,chunks=(min(nShots,1024),nBins))
+  lon,lat=np.empty(nShots),np.empty(nShots)
+  z0,zN=np.empty(nShots),np.empty(nShots)
+
+  # fill a block of shots at a time, to keep RAM down for big files
+  bins=np.arange(nBins)
+  for i0 in range(0,nShots,blockSize):
+    i1=min(i0+blockSize,nShots)
+    n=i1-i0
+    sLon,sLat=flightLines(np.arange(i0,i1),nShots,nLines,rng,lon0,lat0)
+    ground=surface(sLon,sLat)+dZ
+    # the top of the waveform sits a little above the ground
+    top=ground+rng.uniform(0.2,0.6,n)*binRes*nBins
+    groundBin=(top-ground)/binRes
+    block=rng.normal(200,8,(n,nBins))+300*np.exp(-0.5*((bins-groundBin[:,None])/3)**2)
+    waves[i0:i1]=np.clip(block,0,None).astype(np.uint16)
+    lon[i0:i1],lat[i0:i1]=sLon,sLat
+    z0[i0:i1],zN[i0:i1]=top,top-binRes*(nBins-1)
+
+  # the first and last bin coordinates straddle the footprint centre
+  f.create_dataset('LON0',data=lon+0.00001)
+  f.create_dataset('LAT0',data=lat+0.00001)
+  f.create_dataset('LON'+str(nBins-1),data=lon-0.00001)
+  f.create_dataset('LAT'+str(nBins-1),data=lat-0.00001)
+  f.create_dataset('Z0',data=z0)
+  f.create_dataset('Z'+str(nBins-1),data=zN)
+  f.create_dataset('LFID',data=np.full(nShots,1408,dtype=np.uint32))
+  f.create_dataset('SHOTNUMBER',data=np.arange(nShots,dtype=np.uint32))
+  f.close()
+  return
+
+
+###################################
+
+def flightLines(shots,nShots,nLines,rng,lon0=260.0,lat0=-75.5):
+  '''
+  Place shot numbers along parallel flight lines,
+  each about 0.5 degrees long and 0.02 wide,
+  with gaps of 0.03 degrees between lines
+  '''
+  perLine=int(np.ceil(nShots/nLines))
+  line=shots//perLine
+  along=(shots%perLine)/perLine
+  across=rng.uniform(0,0.02,len(shots))
+  return lon0+0.5*along,lat0+0.05*line+across
+
+
+###################################
+
+def surface(lon,lat):
+  '''
+  A smooth ice surface, in metres
+  '''
+  return 200+50*np.sin(lon*20)+30*np.cos(lat*15)
+
+
+###################################
+
+if __name__=="__main__":
+  '''Main block'''
+  import sys
+  makeLVIS(sys.argv[1])
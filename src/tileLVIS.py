@@ -0,0 +1,204 @@
+
+'''
+A class to read an LVIS file once
+and hand out spatial tiles of it
+'''
+
+###################################
+import numpy as np
+from lvisClass import lvisData,readCentres,findInBounds
+from lvisIndex import lvisIndex
+from lvisCache import openLVIS
+from prefetch import read_ahead
+
+
+###################################
+
+class lvisTiles(object):
+  '''
+  Opens an LVIS file once and hands
+  out tiles of it as lvisData objects
+  '''
+
+  def __init__(self,filename,dataClass=lvisData,inMemory=True,useIndex=False):
+    '''
+    Class initialiser. Reads the footprint
+    centres of the file once.
+    dataClass is the class of the tiles.
+    inMemory reads all the datasets in a single
+    pass, otherwise the file is kept open and
+    only the rows of each tile are read.
+    useIndex takes the centres from the file's
+    lvisIndex sidecar, and only tests the shots in
+    the grid cells overlapping each tile
+    '''
+    self.filename=filename
+    self.dataClass=dataClass
+    self.inMemory=inMemory
+    self.index=lvisIndex(filename) if useIndex else None
+    self.readFile()
+
+
+  ###########################################
+
+  def readFile(self):
+    '''
+    Read the coordinates and set up the datasets
+    '''
+    self.f=openLVIS(self.filename)
+    # determine how many bins
+    self.nBins=self.f['RXWAVE'].shape[1]
+    # find a single coordinate per footprint
+    if(self.index is not None):
+      self.lon,self.lat=self.index.lon,self.index.lat
+      self.bounds=self.index.bounds
+    else:
+      self.lon,self.lat=readCentres(self.f,self.nBins)
+      self.bounds=[np.min(self.lon),np.min(self.lat),np.max(self.lon),np.max(self.lat)]
+    # datasets needed by the tiles
+    self.data={}
+    for name in ['LFID','SHOTNUMBER','RXWAVE','Z0','Z'+str(self.nBins-1)]:
+      if(self.inMemory):
+        self.data[name]=self.f[name][()]
+      else:
+        self.data[name]=self.f[name]
+    if(self.inMemory):
+      self.close()
+
+
+  ###########################################
+
+  def close(self):
+    '''
+    Close the file, if still open
+    '''
+    if(self.f is not None):
+      self.f.close()
+      self.f=None
+
+
+  ###########################################
+
+  def getTile(self,minX,minY,maxX,maxY):
+    '''
+    Return the data within a box
+    as a dataClass object
+    '''
+    if(self.index is not None):
+      useInd=self.index.findInBounds(minX,minY,maxX,maxY)
+    else:
+      useInd=findInBounds(self.lon,self.lat,minX,minY,maxX,maxY)
+    return(self.dataClass.fromSource(self.data,useInd,self.lon,self.lat))
+
+
+  ###########################################
+
+  def boxes(self,step):
+    '''
+    Corners of square tiles of size step,
+    starting from the bottom left corner
+    '''
+    for x0 in np.arange(self.bounds[0],self.bounds[2],step):  # loop over x tiles
+      x1=x0+step   # the right side of the tile
+      for y0 in np.arange(self.bounds[1],self.bounds[3],step):  # loop over y tiles
+        y1=y0+step  # the top of the tile
+        yield(x0,y0,x1,y1)
+
+
+  ###########################################
+
+  def tiles(self,step,prefetch=0):
+    '''
+    Loop over square tiles of size step,
+    starting from the bottom left corner.
+    Yields the tile corners and data,
+    skipping tiles with no data.
+    prefetch reads that many tiles ahead in a
+    background thread, while the current one is used
+    '''
+    if(prefetch>0):
+      tiles=read_ahead(self.boxes(step),lambda box:self.getTile(*box),prefetch)
+    else:
+      tiles=((box,self.getTile(*box)) for box in self.boxes(step))
+    for (x0,y0,x1,y1),tile in tiles:
+      if(tile.nWaves==0):
+        continue
+      yield(x0,y0,x1,y1,tile)
+
+
+  ###########################################
+
+  def kdTiles(self,maxShots,prefetch=0):
+    '''
+    Loop over the tiles of kdSplit(), each holding
+    at most maxShots shots. Yields the tile corners
+    and data. No tile is empty.
+    prefetch reads that many tiles ahead in a
+    background thread, while the current one is used
+    '''
+    leaves=kdSplit(self.lon,self.lat,maxShots)
+    load=lambda leaf:self.dataClass.fromSource(self.data,leaf[4],self.lon,self.lat)
+    if(prefetch>0):
+      tiles=read_ahead(leaves,load,prefetch)
+    else:
+      tiles=((leaf,load(leaf)) for leaf in leaves)
+    for (x0,y0,x1,y1,useInd),tile in tiles:
+      yield(x0,y0,x1,y1,tile)
+
+
+###########################################
+
+def kdSplit(lon,lat,maxShots):
+  '''
+  Split footprints in to boxes of at most maxShots
+  shots, cutting the longer side of each box at its
+  median shot until all are small enough. Returns a
+  list of (minX,minY,maxX,maxY,useInd), with each box
+  fitted around its shots as findInBounds() tests them,
+  so no box is empty and no two boxes overlap
+  '''
+  lon=np.asarray(lon)
+  lat=np.asarray(lat)
+  if(len(lon)==0):
+    return([])
+  # degrees of longitude are shorter away from the equator
+  scale=np.cos(np.radians(np.mean(lat)))
+  leaves=[]
+  todo=[np.arange(len(lon))]
+  while(len(todo)>0):
+    useInd=todo.pop()
+    x,y=lon[useInd],lat[useInd]
+    if(len(useInd)>maxShots):
+      left=medianSplit(x,y,scale)
+      if(left is not None):
+        # the left or lower half comes out first
+        todo.append(useInd[~left])
+        todo.append(useInd[left])
+        continue
+    leaves.append((np.min(x),np.min(y),np.nextafter(np.max(x),np.inf),np.nextafter(np.max(y),np.inf),useInd))
+  return(leaves)
+
+
+###########################################
+
+def medianSplit(x,y,scale=1.0):
+  '''
+  Which shots fall below the median of the longer
+  side, trying the other side if every shot has the
+  same coordinate. None if the shots cannot be split
+  '''
+  if((np.max(x)-np.min(x))*scale>=np.max(y)-np.min(y)):
+    axes=[x,y]
+  else:
+    axes=[y,x]
+  for v in axes:
+    mid=np.partition(v,len(v)//2)[len(v)//2]
+    left=v<mid
+    if(not left.any()):
+      left=v<=mid
+    if(left.any() and not left.all()):
+      return(left)
+  return(None)
+
+
+###########################################
@@ -0,0 +1,65 @@
+
+'''
+Cached pyproj transformers, so that
+coordinate systems are only set up
+once per process
+'''
+
+###################################
+import numpy as np
+from functools import lru_cache
+from pyproj import Transformer
+
+
+###################################
+
+@lru_cache(maxsize=None)
+def getTransformer(inEPSG,outEPSG):
+  '''
+  Return the transformer between two EPSG codes,
+  making it the first time it is asked for.
+  Axis order follows the EPSG definitions, so
+  EPSG:4326 takes lat then lon, as pyproj.transform did
+  '''
+  return(Transformer.from_crs("epsg:"+str(inEPSG),"epsg:"+str(outEPSG)))
+
+
+###################################
+
+def transformCoords(x,y,outEPSG,inEPSG=4326,bounds=None,densifyPts=21):
+  '''
+  Transform arrays of coordinates. The arrays
+  are copied once to contiguous float64 and
+  transformed in place. If bounds (minX,minY,maxX,maxY
+  in the input axis order) are given, densifyPts points
+  along each edge of the box are transformed in the same
+  call and the bounds of the transformed edges are
+  returned as well, as in a projection such as polar
+  stereographic the box's edges bulge out past its
+  corners. The box must not contain a pole
+  '''
+  nPoints=len(x)
+  # pack the points and points along the edges of the box together
+  if(bounds is not None):
+    alongX=np.linspace(bounds[0],bounds[2],densifyPts)
+    alongY=np.linspace(bounds[1],bounds[3],densifyPts)
+    edgeX=np.concatenate((alongX,alongX,np.full(densifyPts,bounds[0]),np.full(densifyPts,bounds[2])))
+    edgeY=np.concatenate((np.full(densifyPts,bounds[1]),np.full(densifyPts,bounds[3]),alongY,alongY))
+    newX=np.concatenate((np.asarray(x,dtype=np.float64),edgeX))
+    newY=np.concatenate((np.asarray(y,dtype=np.float64),edgeY))
+  else:
+    newX=np.array(x,dtype=np.float64)
+    newY=np.array(y,dtype=np.float64)
+
+  # reproject in place
+  getTransformer(inEPSG,outEPSG).transform(newX,newY,inplace=True)
+
+  if(bounds is None):
+    return(newX,newY)
+  edgeX=newX[nPoints:]
+  edgeY=newY[nPoints:]
+  outBounds=[np.min(edgeX),np.min(edgeY),np.max(edgeX),np.max(edgeY)]
+  return(newX[:nPoints],newY[:nPoints],outBounds)
+
+
+###################################
@@ -2,15 +2,32 @@ import rasterio
 import numpy as np
 import os
 from rasterio.warp import Resampling
+from rasterio.windows import Window
+from rasterio.vrt import WarpedVRT
+from metrics import timed, file_size
+from cogTiff import cogWriter
 
 
 class volume_analysis:
-    def __init__(self, dem_path_1, dem_path_2):
-        """Initialize, loading two DEM files"""
+    @timed("volume_analysis", lambda self, dem_path_1, dem_path_2, *args, **kwargs: {
+        "bytes_read": 0 if self.windowed else file_size(dem_path_1) + file_size(dem_path_2)})
+    def __init__(self, dem_path_1, dem_path_2, windowed=False, block_size=1024):
+        """Initialize, loading two DEM files. With windowed, only the metadata is read and
+        the DEMs are streamed block by block when the results are needed"""
         self.dem_path_1 = dem_path_1
         self.dem_path_2 = dem_path_2
-        self.dem1, self.transform, self.profile = self.read_tiff(dem_path_1)
-        self.dem2, _, _ = self.read_tiff(dem_path_2)
+        self.windowed = windowed
+        self.block_size = block_size
+        self.results = None
+        if windowed:
+            self.dem1 = self.dem2 = None
+            self.transform, self.profile = self.read_meta(dem_path_1)
+            _, profile2 = self.read_meta(dem_path_2)
+            if (profile2["height"], profile2["width"]) != (self.profile["height"], self.profile["width"]):
+                raise ValueError("DEMs are different sizes, resample one on to the other first")
+        else:
+            self.dem1, self.transform, self.profile = self.read_tiff(dem_path_1)
+            self.dem2, _, _ = self.read_tiff(dem_path_2)
 
     def read_tiff(self, tiff_path):
         """Read geotiff data and return arrays, transform and metadata"""
@@ -25,33 +42,48 @@ class volume_analysis:
             profile = dataset.profile  # Get the metadata
         return dem_data, transform, profile
 
-    def resample_raster(dem1_in, dem2_ref_in, dem1_out):
-        """Resample two DEMs to the same resolution and size in order to process calculation"""
+    def read_meta(self, tiff_path):
+        """Read only the transform and metadata of a geotiff"""
+        if not os.path.exists(tiff_path):
+            raise FileNotFoundError(f"File not found: {tiff_path}")
+
+        with rasterio.open(tiff_path) as dataset:
+            return dataset.transform, dataset.profile
+
+    @timed("resample_raster", lambda dem1_in, dem2_ref_in, dem1_out, *args, **kwargs: {
+        "bytes_read": file_size(dem1_in), "bytes_written": file_size(dem1_out)})
+    def resample_raster(dem1_in, dem2_ref_in, dem1_out, block_size=1024, num_threads="ALL_CPUS", resampling=Resampling.bilinear):
+        """Resample a DEM on to the grid of the reference DEM in order to process calculation.
+        The warp is aligned by transform and written window by window, using several warp threads"""
         print("Resampling DEMs...")
         with rasterio.open(dem2_ref_in) as ref:
-            ref_profile = ref.profile
+            ref_crs = ref.crs
             ref_transform = ref.transform
             ref_height = ref.height
             ref_width = ref.width
 
         with rasterio.open(dem1_in) as src:
-            data = src.read(
-                out_shape=(src.count, ref_height, ref_width),
-                resampling=Resampling.bilinear
-            )
-
             # Update metadata
             profile = src.profile
             profile.update({
+                "driver": "GTiff",
+                "crs": ref_crs,
                 "height": ref_height,
                 "width": ref_width,
                 "transform": ref_transform
             })
 
-            # Save as new file
-            with rasterio.open(dem1_out, 'w', **profile) as dst:
-                dst.write(data)
-    
+            # Warp on the fly, only as each window is read
+            with WarpedVRT(src, crs=ref_crs, transform=ref_transform, width=ref_width, height=ref_height,
+                           nodata=src.nodata, resampling=resampling, NUM_THREADS=num_threads) as vrt:
+
+                # Save as new file
+                with cogWriter(dem1_out, **profile) as dst:
+                    for row in range(0, ref_height, block_size):
+                        for col in range(0, ref_width, block_size):
+                            window = Window(col, row, min(block_size, ref_width - col), min(block_size, ref_height - row))
+                            dst.write(vrt.read(window=window), window=window)
+
     def compute_elevation_change(self):
         """Calculate the variation of elevation"""
         # Get the sharing zones between two DEMs, ignoring nodata zones
@@ -60,8 +92,56 @@ class volume_analysis:
         elevation_diff = np.where(mask, self.dem2 - self.dem1, 0)  # Calculate the variation
         return elevation_diff
 
+    @timed("analyse_blocks", lambda self, output_path=None: {
+        "bytes_read": file_size(self.dem_path_1) + file_size(self.dem_path_2), "bytes_written": file_size(output_path)})
+    def analyse_blocks(self, output_path=None):
+        """Stream both DEMs block by block, accumulating the volume change and number of
+        valid pixels in one pass and writing the difference tif if output_path is given"""
+        nodata = self.profile["nodata"]
+        pixel_area = abs(self.transform.a) * abs(self.transform.e)
+        height, width = self.profile["height"], self.profile["width"]
+        total = 0.0
+        valid_pixels = 0
+
+        dst = None
+        if output_path is not None:
+            profile = self.profile.copy()
+            profile.update(dtype=rasterio.float32, count=1)
+            dst = cogWriter(output_path, **profile)
+        try:
+            with rasterio.open(self.dem_path_1) as src1, rasterio.open(self.dem_path_2) as src2:
+                for row in range(0, height, self.block_size):
+                    for col in range(0, width, self.block_size):
+                        window = Window(col, row, min(self.block_size, width - col), min(self.block_size, height - row))
+                        dem1 = src1.read(1, window=window).astype(np.float32)
+                        dem2 = src2.read(1, window=window).astype(np.float32)
+
+                        # Same masking as compute_elevation_change
+                        mask = (dem1 != nodata) & (dem2 != nodata)
+                        elevation_diff = np.where(mask, dem2 - dem1, 0).astype(np.float32)
+                        total += float(np.sum(elevation_diff, dtype=np.float64))
+                        valid_pixels += int(np.count_nonzero(mask))
+                        if dst is not None:
+                            dst.write(elevation_diff, 1, window=window)
+        except BaseException:
+            if dst is not None:
+                dst.abort()
+            raise
+        if dst is not None:
+            dst.close()
+
+        volume_change = total * pixel_area  # Cubic meter
+        Sea_level_change = (-100)*volume_change/3.6e14 # Centimeter
+        self.results = (volume_change, Sea_level_change, valid_pixels)
+        return self.results
+
     def compute_volume_change(self):
         """Calculate the varriation of volume"""
+        if self.windowed:
+            if self.results is None:
+                self.analyse_blocks()
+            return self.results[0], self.results[1]
+
         elevation_diff = self.compute_elevation_change()
 
         # Calculate the zones area
@@ -74,17 +154,24 @@ class volume_analysis:
         Sea_level_change = (-100)*volume_change/3.6e14 # Centimeter
         return volume_change, Sea_level_change
 
+    @timed("save_elevation_difference_tiff", lambda self, output_path: {"bytes_written": file_size(output_path)})
     def save_elevation_difference_tiff(self, output_path):
         """Save the geotiff file indicating variation of elevation"""
 
         print('Saving variation results...')
+        if self.windowed:
+            # The volume change comes for free in the same pass
+            self.analyse_blocks(output_path)
+            print(f"Variation image saved to: {output_path}")
+            return
+
         elevation_diff = self.compute_elevation_change()
 
         # Updata metadata
         self.profile.update(dtype=rasterio.float32, count=1)
 
         # Save as tif file
-        with rasterio.open(output_path, 'w', **self.profile) as dst:
+        with cogWriter(output_path, **self.profile) as dst:
             dst.write(elevation_diff, 1)
         
         print(f"Variation image saved to: {output_path}")
@@ -94,4 +181,6 @@ class volume_analysis:
         volume_change, Sea_level_change = self.compute_volume_change()
         print(f"Total volume variation: {volume_change:.2f} m\u00B3")
         print(f"Estimated sea level variation: {Sea_level_change:.2f} cm")
+        if self.windowed:
+            print(f"Valid pixels in both DEMs: {self.results[2]}")
         return volume_change